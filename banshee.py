@@ -33,6 +33,23 @@ closed_status = "" #"Not Running"
 loading_status = "Loading..."
 idle_status = "Idle"
 
+# When listening, seconds to wait for a burst of changes (eg skipping through
+# tracks) to settle before showing the result, and the longest to ever wait
+# after the first change of a burst (0: show every change right away)
+coalesce_delay = 0.15
+coalesce_max_delay = 0.5
+
+# When listening, statuses waiting to be sent to each output before the oldest
+# is dropped, and seconds to wait on a slow output (eg awesome's Eval) per send
+sink_queue_size = 4
+sink_timeout = 2.0
+
+# When listening, whether to time each stage of getting a change to the
+# outputs, for dumping with SIGUSR1 (or the stats command, for the daemon),
+# and how many of the latest timings per stage to summarize
+collect_stats = True
+stats_window = 1000
+
 ####
 
 banshee_status_interface = "org.bansheeproject.Banshee"
@@ -41,6 +58,7 @@ banshee_status_controller_path = "/org/bansheeproject/Banshee/PlaybackController
 
 banshee_listen_interface = "org.bansheeproject.Banshee.PlayerEngine"
 banshee_listen_signal = "EventChanged"
+banshee_state_signal = "StateChanged"
 
 shutdown_listen_interface = "org.freedesktop.DBus"
 shutdown_listen_signal = "NameOwnerChanged"
@@ -50,7 +68,71 @@ dbus_send_interface = "org.naquadah.awesome.awful"
 dbus_send_path = "/org/naquadah/awesome/awful/Remote"
 dbus_send_cmd = "Eval"
 
-import cgi, dbus, sys
+# Unix socket where the daemon serves status/commands to other invocations, or
+# "" for "banshee-status.sock" in $XDG_RUNTIME_DIR (or when that's not set, in a
+# "banshee-<uid>" directory which only this user may access, in the temp directory)
+daemon_socket_path = ""
+# Seconds to wait for the daemon to answer (once connected, there's no falling
+# back to querying Banshee directly, since the daemon may have acted on a control)
+daemon_timeout = 1.0
+
+import cgi, collections, errno, os, re, signal, socket, stat, struct, sys, tempfile, threading, time
+
+# Imported on first use by load_dbus(), so that commands answered by the daemon don't pay for it
+dbus = None
+
+def load_dbus():
+    global dbus
+    if not dbus:
+        import dbus
+
+# Counters and rolling timings of the listener's stages, see collect_stats
+class Stats:
+    def __init__(self, window = stats_window):
+        self.__lock = threading.Lock()
+        self.__started = time.time()
+        self.__window = window
+        self.__counters = {}
+        # {stage: deque of the latest seconds}
+        self.__samples = {}
+        # {stage: [count, max]} over all time
+        self.__totals = {}
+
+    def count(self, name, n = 1):
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        with self.__lock:
+            samples = self.__samples.get(name)
+            if samples is None:
+                samples = collections.deque(maxlen=self.__window)
+                self.__samples[name] = samples
+                self.__totals[name] = [0, 0]
+            samples.append(seconds)
+            totals = self.__totals[name]
+            totals[0] += 1
+            totals[1] = max(totals[1], seconds)
+
+    def report(self):
+        with self.__lock:
+            lines = ["Uptime: %ds" % (time.time() - self.__started)]
+            for name in sorted(self.__counters):
+                lines.append("%s: %d" % (name, self.__counters[name]))
+            for name in sorted(self.__samples):
+                samples = sorted(self.__samples[name])
+                pct = lambda p: samples[min(len(samples) - 1, int(p * len(samples)))] * 1000
+                lines.append("%s: %d total (max %.1fms), last %d: mean %.1fms p50 %.1fms p90 %.1fms p99 %.1fms max %.1fms" %
+                             (name, self.__totals[name][0], self.__totals[name][1] * 1000, len(samples),
+                              sum(samples) * 1000 / len(samples), pct(0.5), pct(0.9), pct(0.99), samples[-1] * 1000))
+            return "\n".join(lines)
+
+    # For SIGUSR1: writes the report to stderr, since stdout may be a status pipe
+    def dump(self, signum = None, frame = None):
+        sys.stderr.write(self.report() + "\n")
+        sys.stderr.flush()
+
+stats = collect_stats and Stats() or None
 
 def help_exit():
     sys.stderr.write('''Args: %s <command> [track-format] [err-format]
@@ -62,59 +144,258 @@ Commands:
   status - Prints current track status, using 'format' if specified.
   listen_print - Runs continuously, printing status on changes, using 'format' if specified.
   listen_dbus - Same as listen_print, except sending 'format' to a dbus destination.
-''' % sys.argv[0])
+  listen <outputs> - Same as listen_print, except sending status to each of a
+           comma-separated list of outputs, each one of:
+             print - stdout
+             dbus - the dbus destination used by listen_dbus
+             file:<path> - replaces the file with each status
+             socket:<path> - writes a line to a listening unix socket
+           eg: %s listen print,file:/tmp/np.txt '%%(name)s'
+  listen_async <outputs> - Same as listen, except using an asyncio event loop
+           (needs trollius) and its own D-Bus client, instead of GLib and dbus-python.
+  stats - Prints the daemon's counters and timings (send SIGUSR1 to other listeners).
+  daemon - Runs continuously, answering the other commands from other invocations
+           over a unix socket, so that they don't need to query Banshee themselves.
+''' % (sys.argv[0], sys.argv[0]))
     sys.exit(1)
 
+# Keeps one bus connection and one proxy per (name, path), instead of
+# reconnecting and introspecting on every call. Proxies are bound to whichever
+# process owned the name when they were created, so they're dropped when
+# NameOwnerChanged says the name moved (or when a call through them fails).
+class DbusObjects:
+    def __init__(self):
+        self.__bus = None
+        # {name: whether it has an owner}
+        self.__owners = {}
+        # {(name, path): proxy}
+        self.__proxies = {}
+        # whether NameOwnerChanged is being received, so that it's safe to
+        # remember that a name has no owner
+        self.__watching = False
+        # outputs may send from their own threads
+        self.__lock = threading.RLock()
+
+    def __get_bus(self):
+        if not self.__bus:
+            self.__bus = dbus.SessionBus()
+        return self.__bus
+
+    # Uses 'bus' (eg one with a main loop) from now on, and keeps the cache up
+    # to date with NameOwnerChanged
+    def watch(self, bus):
+        self.__bus = bus
+        self.__owners.clear()
+        self.__proxies.clear()
+        bus.add_signal_receiver(self.name_owner_changed, shutdown_listen_signal, shutdown_listen_interface)
+        self.__watching = True
+
+    def name_owner_changed(self, name, old_owner, new_owner):
+        with self.__lock:
+            if name in self.__owners:
+                self.__owners[name] = bool(new_owner)
+            self.invalidate(name)
+
+    # Forgets any proxies for 'name', eg after a call through one failed
+    def invalidate(self, name):
+        with self.__lock:
+            for key in self.__proxies.keys():
+                if key[0] == name:
+                    del self.__proxies[key]
+            if not self.__watching:
+                self.__owners.pop(name, None)
+
+    # Returns the DBus object, or None if autostart is false and it's not running
+    def get(self, name, path, autostart = True):
+        with self.__lock:
+            return self.__get(name, path, autostart)
+
+    def __get(self, name, path, autostart):
+        proxy = self.__proxies.get((name, path))
+        if proxy:
+            return proxy
+        bus = self.__get_bus()
+
+        # get_object will launch banshee, so manually check if it's running
+        running = self.__owners.get(name)
+        if running is None:
+            try:
+                bus.get_name_owner(name)
+                running = True
+            except:
+                running = False
+            if running or self.__watching:
+                self.__owners[name] = running
+        if not running and not autostart:
+            # banshee isn't running
+            return None
+
+        proxy = bus.get_object(name, path)
+        self.__proxies[(name, path)] = proxy
+        return proxy
+
+dbus_objects = DbusObjects()
+
 # Returns the DBus object for Banshee, or None if autostart is false and it's not running
 def get_dbus_obj(name, path, autostart = True):
-    bus = dbus.SessionBus()
+    return dbus_objects.get(name, path, autostart)
 
-    # get_object will launch banshee, so manually check if it's running
-    try:
-        bus.get_name_owner(name)
-    except:
-        # banshee isn't running
-        if not autostart:
-            return None
+# Keys which may be used in a track format, see "Available keys" above
+track_keys = frozenset(["album", "album-artist", "artist", "artwork-id", "bit-rate",
+                        "comment", "composer", "date-added", "file-size", "genre",
+                        "is-compilation", "last-skipped", "length", "local-path", "media-attributes",
+                        "mime-type", "name", "rating", "sample-rate", "score",
+                        "skip-count", "track-number", "URI", "year"])
+# Number of rendered tracks/messages each Formatter remembers
+format_cache_size = 64
+# Number of Formatters kept for reuse (each daemon request may bring its own format)
+formatter_cache_size = 16
 
-    return bus.get_object(name, path)
+_format_key_re = re.compile(r"%\(([^)]*)\)")
+# a key along with its conversion type, eg "%(year)04d" -> ("year", "d")
+_format_conversion_re = re.compile(r"%\(([^)]*)\)[#0 +-]*\d*(?:\.\d*)?[hlL]?([a-zA-Z%])")
+# what a key missing from a track is shown as, by conversion type (otherwise "")
+_missing_values = dict([(c, 0) for c in "diouxXeEfFgG"] + [("c", u" ")])
 
-def _format_msg(err_format, msg, form = None):
-    try:
-	# cgi.escape: awesomewm dislikes any use of "&" and "<"
-        if form:
-            return cgi.escape(unicode(form % msg).encode("utf-8"))
-        else:
-            return cgi.escape(unicode(err_format % msg).encode("utf-8"))
-    except KeyError, e:
-        return unicode(err_format % ("Bad format: Not found: %s" % e)).encode("utf-8")
-    except:
-        return unicode(err_format % ("Exception: %s" % sys.exc_info()[1])).encode("utf-8")
+# Banshee leaves out keys which have no value for a track (eg no album).
+# These get a value which fits their conversion in the format, see _missing_values.
+class _TrackValues(dict):
+    def __init__(self, track, missing):
+        dict.__init__(self, track)
+        self.__missing = missing
 
-def get_status(track_format, err_format):
+    def __missing__(self, key):
+        return self.__missing.get(key, u"")
+
+# For checking a format's syntax: fits any conversion, eg "%(year)d" or "%(name)s"
+class _AnyValues(dict):
+    def __missing__(self, key):
+        return 0
+
+# Renders tracks and messages with a track format and an error format. The
+# formats are checked once when created, raising ValueError if they're bad,
+# and rendered output is remembered so that the same track costs nothing the
+# next time around.
+class Formatter:
+    def __init__(self, track_format, err_format):
+        if not isinstance(track_format, unicode):
+            track_format = track_format.decode("utf-8")
+        if not isinstance(err_format, unicode):
+            err_format = err_format.decode("utf-8")
+        keys = _format_key_re.findall(track_format)
+        unknown = sorted(set(k for k in keys if not k in track_keys))
+        if unknown:
+            raise ValueError("Bad format: Not found: %s" % ", ".join(unknown))
+        try:
+            track_format % _AnyValues()
+            err_format % u""
+        except (ValueError, TypeError, KeyError), e:
+            raise ValueError("Bad format: %s" % e)
+        self.__track_format = track_format
+        self.__err_format = err_format
+        # only these values of a track affect its output
+        self.__keys = tuple(sorted(set(keys)))
+        self.__missing = dict((k, _missing_values[conv])
+                              for k, conv in _format_conversion_re.findall(track_format)
+                              if conv in _missing_values)
+        self.__tracks = {}
+        self.__messages = {}
+
+    def __render(self, form, args):
+        try:
+            # cgi.escape: awesomewm dislikes any use of "&" and "<"
+            return cgi.escape((form % args).encode("utf-8"))
+        except:
+            return cgi.escape((self.__err_format % ("Exception: %s" % sys.exc_info()[1])).encode("utf-8"))
+
+    def __remember(self, cache, key, value):
+        if len(cache) >= format_cache_size:
+            cache.clear()
+        cache[key] = value
+
+    def track(self, track):
+        try:
+            key = tuple(track.get(k) for k in self.__keys)
+            out = self.__tracks.get(key)
+        except TypeError:
+            # unhashable values: just render it
+            return self.__render(self.__track_format, _TrackValues(track, self.__missing))
+        if out is None:
+            out = self.__render(self.__track_format, _TrackValues(track, self.__missing))
+            self.__remember(self.__tracks, key, out)
+        return out
+
+    def message(self, msg):
+        out = self.__messages.get(msg)
+        if out is None:
+            out = self.__render(self.__err_format, msg)
+            self.__remember(self.__messages, msg, out)
+        return out
+
+    # Renders a (state, track) pair from query_status() or Handler.snapshot()
+    def status(self, state, track):
+        if state is None:
+            return self.message(closed_status)
+        elif state == "idle":
+            return self.message(idle_status)
+        elif state == "notready":
+            return self.message(loading_status)
+        elif track is None:
+            # started, but we haven't heard about a track yet
+            return self.message(loading_status)
+        return self.track(track)
+
+_formatters = {}
+
+# Returns a (shared) Formatter for the formats, raising ValueError if they're bad
+def get_formatter(track_format, err_format):
+    formatter = _formatters.get((track_format, err_format))
+    if not formatter:
+        formatter = Formatter(track_format, err_format)
+        if len(_formatters) >= formatter_cache_size:
+            _formatters.clear()
+        _formatters[(track_format, err_format)] = formatter
+    return formatter
+
+# Returns Banshee's (state, current track), with a state of None if it isn't running,
+# and a track of None if there's no track to show
+def query_status(retry = True):
     # False: if banshee is closed, dont start it
     banshee = get_dbus_obj(banshee_status_interface, banshee_status_engine_path, False)
     if not banshee:
-        return _format_msg(err_format, closed_status)
-    # in case no track is even selected..
-    state = banshee.GetCurrentState()
-    if state == "idle":
-        return _format_msg(err_format, idle_status)
-    elif state == "notready":
-        return _format_msg(err_format, loading_status)
-    else:
-        track = banshee.GetCurrentTrack()
-        return _format_msg(err_format, track, track_format)
+        return (None, None)
+    try:
+        # in case no track is even selected..
+        state = banshee.GetCurrentState()
+        if state == "idle" or state == "notready":
+            return (state, None)
+        return (state, banshee.GetCurrentTrack())
+    except dbus.DBusException:
+        # eg banshee restarted without us hearing about it: retry with a new proxy
+        dbus_objects.invalidate(banshee_status_interface)
+        if not retry:
+            raise
+        return query_status(False)
+
+def get_status(track_format, err_format):
+    try:
+        formatter = get_formatter(track_format, err_format)
+    except ValueError, e:
+        return str(e)
+    return formatter.status(*query_status())
 
 class PrintSender:
     def send(self, sendme):
         print sendme
+        # for whatever's reading from a pipe
+        sys.stdout.flush()
 
 class DbusSender:
-    def __init__(self, dbus_name, dbus_path, dbus_cmd):
+    def __init__(self, dbus_name, dbus_path, dbus_cmd, timeout = sink_timeout):
         self.__dbus_name = dbus_name
         self.__dbus_path = dbus_path
         self.__dbus_cmd = dbus_cmd
+        self.__timeout = timeout
 
     def send(self, sendme):
         #print "SEND:", sendme
@@ -122,88 +403,1000 @@ class DbusSender:
             out = get_dbus_obj(self.__dbus_name, self.__dbus_path)
         except:
             print "DBus Exception: %s" % sys.exc_info()[1]
-            return
+            return False
         interface = self.__dbus_path[1:].replace('/','.')
 
-        err = out.get_dbus_method(self.__dbus_cmd)(sendme, dbus_interface=interface)
+        try:
+            err = out.get_dbus_method(self.__dbus_cmd)(sendme, dbus_interface=interface,
+                                                       timeout=self.__timeout)
+        except dbus.DBusException:
+            # eg awesome restarted: get a new proxy next time
+            dbus_objects.invalidate(self.__dbus_name)
+            print "DBus Exception: %s" % sys.exc_info()[1]
+            return False
         if err:
             print err
 
+# Replaces a file with each status, so that readers never see a partial one
+class FileSender:
+    def __init__(self, path):
+        self.__path = path
+        self.__tmp_path = "%s.%d.tmp" % (path, os.getpid())
+
+    def send(self, sendme):
+        try:
+            out = open(self.__tmp_path, "w")
+            out.write(sendme + "\n")
+            out.close()
+            os.rename(self.__tmp_path, self.__path)
+        except (IOError, OSError), e:
+            print "Couldn't write %s: %s" % (self.__path, e)
+            return False
+
+# Writes each status as a line to a listening unix socket, reconnecting as needed
+class SocketSender:
+    def __init__(self, path, timeout = sink_timeout):
+        self.__path = path
+        self.__timeout = timeout
+        self.__sock = None
+
+    def send(self, sendme):
+        try:
+            if not self.__sock:
+                self.__sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.__sock.settimeout(self.__timeout)
+                self.__sock.connect(self.__path)
+            self.__sock.sendall(sendme + "\n")
+        except socket.error, e:
+            print "Couldn't send to %s: %s" % (self.__path, e)
+            if self.__sock:
+                self.__sock.close()
+                self.__sock = None
+            return False
+
+# Passes statuses on to 'sender' from its own thread, so that a slow or stuck
+# output never holds up the main loop. At most 'size' statuses wait to be
+# sent, after which the oldest ones are dropped (and counted in 'dropped').
+# Senders may return False from send() to be counted as failed in the stats.
+class QueuedSender:
+    def __init__(self, sender, name, size = sink_queue_size):
+        self.__sender = sender
+        self.__name = name
+        self.__queue = collections.deque()
+        self.__size = max(1, size)
+        self.__cond = threading.Condition()
+        self.dropped = 0
+        thread = threading.Thread(target=self.__run, name=name)
+        # don't keep the process around just to finish sending
+        thread.daemon = True
+        thread.start()
+
+    def send(self, sendme):
+        with self.__cond:
+            if len(self.__queue) >= self.__size:
+                self.__queue.popleft()
+                self.dropped += 1
+                if stats:
+                    stats.count("dropped.%s" % self.__name)
+            self.__queue.append((sendme, time.time()))
+            self.__cond.notify()
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                while not self.__queue:
+                    self.__cond.wait()
+                sendme, queued = self.__queue.popleft()
+            start = time.time()
+            try:
+                ok = self.__sender.send(sendme) is not False
+            except:
+                print "Sending to %s failed: %s" % (self.__name, sys.exc_info()[1])
+                ok = False
+            if stats:
+                stats.observe("queue.%s" % self.__name, start - queued)
+                stats.observe("send.%s" % self.__name, time.time() - start)
+                stats.count("%s.%s" % (ok and "sent" or "failed", self.__name))
+
+# Sends each status to several senders
+class MultiSender:
+    def __init__(self, senders):
+        self.senders = senders
+
+    def send(self, sendme):
+        for sender in self.senders:
+            sender.send(sendme)
+
+# Returns (kind, path) for an output from the listen command, or raises ValueError
+def parse_output(output):
+    kind, sep, path = output.partition(":")
+    if (kind == "print" or kind == "dbus") and not sep:
+        return (kind, None)
+    elif (kind == "file" or kind == "socket") and path:
+        return (kind, path)
+    raise ValueError("Unknown output: %s" % output)
+
+# Returns a queued sender for an output from the listen command, or raises ValueError
+def make_sender(output):
+    kind, path = parse_output(output)
+    if kind == "print":
+        sender = PrintSender()
+    elif kind == "dbus":
+        sender = DbusSender(dbus_send_interface, dbus_send_path, dbus_send_cmd)
+    elif kind == "file":
+        sender = FileSender(path)
+    else:
+        sender = SocketSender(path)
+    return QueuedSender(sender, output)
+
+# Keeps a snapshot of Banshee's state and current track, updated from its
+# signals, and sends it to 'sender' whenever it changes. Banshee is only asked
+# for the track when a new stream starts (or the snapshot is unknown).
+#
+# If 'timer' is provided (like gobject.timeout_add: timer(milliseconds,
+# callback)), bursts of changes are coalesced into a single query and send,
+# once nothing has changed for coalesce_delay seconds, or coalesce_max_delay
+# seconds after the first change. 'dropped' counts the changes which were
+# coalesced away.
+#
+# 'query' is called with a callback to pass Banshee's (state, track) to once
+# it's known. By default that's right away, using query_status().
 class Handler:
-    def __init__(self, sender, track_format, err_format):
+    def __init__(self, sender, track_format, err_format, timer = None,
+                 delay = coalesce_delay, max_delay = coalesce_max_delay, query = None):
         self.__sender = sender
-        self.__track_format = track_format
-        self.__err_format = err_format
+        self.__query = query or (lambda done: done(*query_status()))
+        # raises ValueError now, instead of on every event, if the formats are bad
+        self.__formatter = get_formatter(track_format, err_format)
+        self.__state = None
+        self.__track = None
+        # whether the snapshot is up to date
+        self.__known = False
+
+        self.__timer = delay > 0 and timer or None
+        self.__delay = delay
+        self.__max_delay = max(delay, max_delay)
+        # None: nothing pending, False: a send, True: a query and send
+        self.__pending = None
+        self.__first = 0
+        self.__last = 0
+        self.dropped = 0
+        # for stats: when the change being handled came in, and when its query started
+        self.__event_time = None
+        self.__query_time = None
+
+    # Returns the (state, track) snapshot, to render with Formatter.status()
+    def snapshot(self):
+        return (self.__state, self.__track)
+
+    def __send(self):
+        if not stats:
+            self.__sender.send(self.__formatter.status(self.__state, self.__track))
+            return
+        start = time.time()
+        sendme = self.__formatter.status(self.__state, self.__track)
+        now = time.time()
+        stats.observe("format", now - start)
+        self.__sender.send(sendme)
+        if self.__event_time:
+            # from the change coming in to the status being handed to the outputs
+            stats.observe("handler", now - self.__event_time)
+            self.__event_time = None
+
+    # Notes a change coming in, for stats
+    def __received(self):
+        if stats:
+            stats.count("events.received")
+
+    def refresh(self):
+        if stats:
+            stats.count("queries")
+            self.__query_time = time.time()
+        self.__query(self.__got_status)
+
+    def __got_status(self, state, track):
+        if stats and self.__query_time:
+            stats.observe("query", time.time() - self.__query_time)
+            self.__query_time = None
+        self.__state = state
+        self.__track = track
+        self.__known = True
+        self.__send()
+
+    # Sends (after querying, if 'query'), either now or once the burst is over
+    def __update(self, query):
+        if stats and not self.__event_time:
+            # (only once it's going to be sent: a change that isn't leaves no latency)
+            self.__event_time = time.time()
+        if not self.__timer:
+            if query:
+                self.refresh()
+            else:
+                self.__send()
+            return
+        now = time.time()
+        if self.__pending is None:
+            self.__pending = query
+            self.__first = now
+            self.__timer(int(self.__delay * 1000), self.__flush)
+        else:
+            self.dropped += 1
+            if stats:
+                stats.count("events.coalesced")
+            self.__pending = self.__pending or query
+        self.__last = now
+
+    # Called by the timer. Returns False to not be called again.
+    def __flush(self):
+        now = time.time()
+        due = min(self.__last + self.__delay, self.__first + self.__max_delay)
+        if now < due:
+            # changed again since this was scheduled: wait for it to settle
+            self.__timer(max(1, int((due - now) * 1000)), self.__flush)
+            return False
+        query = self.__pending
+        self.__pending = None
+        if stats:
+            stats.observe("coalesce", now - self.__first)
+        if query:
+            self.refresh()
+        else:
+            self.__send()
+        return False
 
     def handle_banshee(self, msg, ignorea=None, ignoreb=None):
         #entered new song or opened banshee
-        if not msg == "startofstream" and not msg == "preparevideowindow":
+        if msg == "startofstream":
+            self.__received()
+            self.__known = False
+            self.__update(True)
+        elif msg == "preparevideowindow" and not self.__known:
+            # otherwise it's just following startofstream for the same track
+            self.__received()
+            self.__update(True)
+        elif stats:
             #print "SKIP:", msg
-            return
-        self.__sender.send(get_status(self.__track_format, self.__err_format))
+            stats.count("events.skipped")
+
+    def handle_state(self, state):
+        self.__received()
+        if state == "idle" or state == "notready":
+            self.__state = state
+            self.__track = None
+            self.__update(False)
+        elif not self.__known or self.__track is None:
+            # eg playing again after being idle, without a new stream
+            self.__update(True)
+        else:
+            self.__state = state
 
     def handle_owner(self, name, old_owner, new_owner):
         if not name == banshee_status_interface:
             return
 
+        self.__received()
         if old_owner == "":
             # banshee is starting
-            self.__sender.send(_format_msg(self.__err_format, loading_status))
+            self.__state = "notready"
+            self.__track = None
+            self.__known = False
+            self.__update(False)
         elif new_owner == "":
             # banshee is closing
-            self.__sender.send(_format_msg(self.__err_format, closed_status))
+            self.__state = None
+            self.__track = None
+            self.__known = True
+            self.__update(False)
+
+# Remembers the last status sent by the Handler, and answers requests from
+# other invocations (see daemon_request()) with it over a unix socket. Each
+# request is a line of "<command>[\t<track-format>]", answered with the
+# resulting status before the connection is closed.
+class DaemonServer:
+    def __init__(self, path, track_format, err_format, sender = None):
+        self.__path = path
+        self.__track_format = track_format
+        self.__err_format = err_format
+        self.__formatter = get_formatter(track_format, err_format)
+        # also passes each status on to this, if any
+        self.__sender = sender
+        self.__status = self.__formatter.message(closed_status)
+        # set by serve_from()
+        self.__handler = None
+
+        # a socket left behind by a daemon that was killed refuses connections,
+        # but one that answers belongs to a daemon that's still running
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        probe.settimeout(daemon_timeout)
+        try:
+            probe.connect(path)
+        except socket.error, e:
+            if e.errno == errno.ECONNREFUSED:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            elif e.errno != errno.ENOENT:
+                raise
+        else:
+            raise ValueError("A daemon is already listening on %s" % path)
+        finally:
+            probe.close()
+        self.__sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # only for this user
+        umask = os.umask(077)
+        try:
+            self.__sock.bind(path)
+        finally:
+            os.umask(umask)
+        self.__sock.listen(16)
+
+    def fileno(self):
+        return self.__sock.fileno()
+
+    # Lets status requests with other formats be answered from the handler's snapshot
+    def serve_from(self, handler):
+        self.__handler = handler
+
+    def send(self, sendme):
+        self.__status = sendme
+        if self.__sender:
+            self.__sender.send(sendme)
 
-def cmd_listen(dbus_out, track_format = default_track_format, err_format = default_err_format):
+    # Answers one request. Returns True to keep being called by gobject.io_add_watch.
+    def handle_accept(self, ignorea = None, ignoreb = None):
+        try:
+            conn = self.__sock.accept()[0]
+        except socket.error:
+            return True
+        try:
+            # a stuck client mustn't hold up the main loop
+            conn.settimeout(daemon_timeout)
+            req = ""
+            while not "\n" in req:
+                data = conn.recv(4096)
+                if not data:
+                    break
+                req += data
+            conn.sendall(self.__answer(req.split("\n")[0]) + "\n")
+        except socket.error, e:
+            print "Daemon client error: %s" % e
+        conn.close()
+        return True
+
+    def __answer(self, req):
+        args = req.split("\t")
+        cmd = args[0]
+        try:
+            if cmd in controls:
+                controls[cmd]()
+            elif cmd == "stats":
+                return stats and stats.report() or "Not collecting stats"
+            elif cmd != "status":
+                return self.__formatter.message("Unknown command: %s" % cmd)
+            if cmd == "status" and (len(args) < 2 or args[1] == self.__track_format):
+                # the common case: answered without any D-Bus calls
+                return self.__status
+            form = len(args) >= 2 and args[1] or self.__track_format
+            if cmd == "status" and self.__handler:
+                try:
+                    formatter = get_formatter(form, self.__err_format)
+                except ValueError, e:
+                    return str(e)
+                return formatter.status(*self.__handler.snapshot())
+            return get_status(form, self.__err_format)
+        except:
+            return self.__formatter.message("Exception: %s" % sys.exc_info()[1])
+
+    def close(self):
+        self.__sock.close()
+        try:
+            os.unlink(self.__path)
+        except OSError:
+            pass
+
+# Returns the path of the daemon's socket, see daemon_socket_path. With 'create',
+# the directory for it is created if needed. Raises ValueError if that directory
+# might be accessible by other users.
+def get_daemon_socket_path(create = False):
+    if daemon_socket_path:
+        return daemon_socket_path
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "banshee-status.sock")
+    runtime_dir = os.path.join(tempfile.gettempdir(), "banshee-%d" % os.getuid())
+    if create:
+        try:
+            os.mkdir(runtime_dir, 0700)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise ValueError("Couldn't create %s: %s" % (runtime_dir, e.strerror))
+    try:
+        st = os.lstat(runtime_dir)
+    except OSError:
+        # (no daemon then)
+        return os.path.join(runtime_dir, "status.sock")
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 077:
+        raise ValueError("%s isn't a directory accessible only by this user" % runtime_dir)
+    return os.path.join(runtime_dir, "status.sock")
+
+# SO_PEERCRED isn't in Python 2's socket module
+_so_peercred = getattr(socket, "SO_PEERCRED", sys.platform.startswith("linux") and 17 or None)
+
+# Returns the uid of whoever's at the other end of the connected unix socket 'sock'
+def _socket_owner(sock, path):
+    if _so_peercred:
+        try:
+            # struct ucred: pid, uid, gid
+            creds = sock.getsockopt(socket.SOL_SOCKET, _so_peercred, struct.calcsize("3i"))
+            return struct.unpack("3i", creds)[1]
+        except socket.error:
+            pass
+    return os.stat(path).st_uid
+
+class DaemonError(Exception):
+    pass
+
+# Asks a running daemon to run 'cmd' (a command from main()), returning its
+# answer, or None if there's no daemon to ask. Doesn't use D-Bus at all.
+# Raises DaemonError if the daemon was asked but didn't answer, in which case
+# it may or may not have run 'cmd'.
+def daemon_request(cmd, track_format = None):
+    try:
+        path = get_daemon_socket_path()
+    except ValueError, e:
+        sys.stderr.write("Not using the daemon: %s\n" % e)
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(daemon_timeout)
+    try:
+        sock.connect(path)
+        owner = _socket_owner(sock, path)
+    except (socket.error, OSError):
+        sock.close()
+        return None
+    if owner != os.getuid():
+        sock.close()
+        sys.stderr.write("Not using the daemon: %s belongs to uid %d\n" % (path, owner))
+        return None
+    try:
+        if track_format:
+            sock.sendall("%s\t%s\n" % (cmd, track_format))
+        else:
+            sock.sendall("%s\n" % cmd)
+        resp = ""
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            resp += data
+    except socket.timeout:
+        raise DaemonError("Daemon didn't answer within %ss" % daemon_timeout)
+    except socket.error, e:
+        raise DaemonError("Daemon error: %s" % (e.strerror or e))
+    finally:
+        sock.close()
+    if not resp.endswith("\n"):
+        raise DaemonError("Daemon went away mid-request")
+    return resp[:-1]
+
+# outputs: list of outputs to send status to, see make_sender()
+# serve: whether to also answer requests from other invocations (see DaemonServer)
+def cmd_listen(outputs, track_format = default_track_format, err_format = default_err_format, serve = False):
+    try:
+        get_formatter(track_format, err_format)
+        sender = MultiSender([make_sender(o) for o in outputs])
+    except ValueError, e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
+
+    # outputs send from their own threads
+    import gobject
+    gobject.threads_init()
     # This must come BEFORE calling dbus.SessionBus():
-    from dbus.mainloop.glib import DBusGMainLoop
+    from dbus.mainloop.glib import DBusGMainLoop, threads_init
+    threads_init()
     dbus_loop = DBusGMainLoop()
 
     bus = dbus.SessionBus(mainloop=dbus_loop)
-    if dbus_out:
-        sender = DbusSender(dbus_send_interface, dbus_send_path, dbus_send_cmd)
-    else:
-        sender = PrintSender()
-    handler = Handler(sender, track_format, err_format)
+    dbus_objects.watch(bus)
+    server = None
+    if serve:
+        try:
+            server = DaemonServer(get_daemon_socket_path(True), track_format, err_format, sender)
+        except (ValueError, socket.error), e:
+            sys.stderr.write("Couldn't start daemon: %s\n" % e)
+            sys.exit(1)
+        sender = server
+    handler = Handler(sender, track_format, err_format, gobject.timeout_add)
+    if server:
+        server.serve_from(handler)
 
     bus.add_signal_receiver(handler.handle_banshee, banshee_listen_signal, banshee_listen_interface)
+    bus.add_signal_receiver(handler.handle_state, banshee_state_signal, banshee_listen_interface)
     bus.add_signal_receiver(handler.handle_owner, shutdown_listen_signal, shutdown_listen_interface)
 
-    import gobject
     loop = gobject.MainLoop()
+    if server:
+        gobject.io_add_watch(server, gobject.IO_IN, server.handle_accept)
+        # so that the socket is cleaned up when killed
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if stats:
+        signal.signal(signal.SIGUSR1, stats.dump)
 
     #ping the current status before we start listening for changes
-    handler.handle_banshee("startofstream")
+    handler.refresh()
+
+    try:
+        loop.run()
+    finally:
+        if server:
+            server.close()
+
+# The asyncio listener (listen_async) uses trollius, the asyncio port for
+# python 2, imported on first use by load_asyncio(). Instead of dbus-python and
+# GLib, it talks to the session bus with the small D-Bus client below.
+asyncio = None
+From = None
+Return = None
+
+def load_asyncio():
+    global asyncio, From, Return
+    if not asyncio:
+        import trollius as asyncio
+        from trollius import From, Return
+
+dbus_bus_name = "org.freedesktop.DBus"
+dbus_bus_path = "/org/freedesktop/DBus"
+
+# Alignment of each D-Bus type, and the struct format of the fixed-size ones
+_dbus_align = {"y": 1, "b": 4, "n": 2, "q": 2, "i": 4, "u": 4, "x": 8, "t": 8, "d": 8, "h": 4,
+               "s": 4, "o": 4, "g": 1, "v": 1, "a": 4, "(": 8, "{": 8}
+_dbus_fixed = {"y": "B", "b": "I", "n": "h", "q": "H", "i": "i", "u": "I", "x": "q", "t": "Q", "d": "d", "h": "I"}
+
+# Header fields, see the D-Bus specification
+_dbus_path, _dbus_interface, _dbus_member, _dbus_error_name, _dbus_reply_serial, \
+    _dbus_destination, _dbus_sender, _dbus_signature = range(1, 9)
+_dbus_method_call, _dbus_method_return, _dbus_error, _dbus_signal = range(1, 5)
+_dbus_no_reply_expected = 0x1
+_dbus_no_auto_start = 0x2
+
+# Splits a D-Bus signature into its complete types, eg "sa{sv}i" -> ["s", "a{sv}", "i"]
+def _dbus_split(sig):
+    types = []
+    start = 0
+    while start < len(sig):
+        end = start
+        while sig[end] == "a":
+            end += 1
+        if sig[end] in "({":
+            depth = 0
+            while True:
+                if sig[end] in "({":
+                    depth += 1
+                elif sig[end] in ")}":
+                    depth -= 1
+                end += 1
+                if depth == 0:
+                    break
+        else:
+            end += 1
+        types.append(sig[start:end])
+        start = end
+    return types
+
+class _DbusWriter:
+    def __init__(self):
+        self.data = bytearray()
+
+    def align(self, n):
+        self.data.extend("\0" * (-len(self.data) % n))
+
+    def write(self, t, value):
+        c = t[0]
+        self.align(_dbus_align[c])
+        if c in _dbus_fixed:
+            self.data.extend(struct.pack("<" + _dbus_fixed[c], value))
+        elif c == "s" or c == "o":
+            if isinstance(value, unicode):
+                value = value.encode("utf-8")
+            self.data.extend(struct.pack("<I", len(value)) + value + "\0")
+        elif c == "g":
+            self.data.extend(struct.pack("<B", len(value)) + value + "\0")
+        elif c == "v":
+            # (signature, value)
+            self.write("g", value[0])
+            self.write(value[0], value[1])
+        elif c == "a":
+            start = len(self.data)
+            self.data.extend("\0\0\0\0")
+            self.align(_dbus_align[t[1]])
+            body = len(self.data)
+            if t[1] == "{":
+                value = value.items()
+            for item in value:
+                self.write(t[1:], item)
+            self.data[start:start + 4] = struct.pack("<I", len(self.data) - body)
+        else:
+            for sub, v in zip(_dbus_split(t[1:-1]), value):
+                self.write(sub, v)
+
+class _DbusReader:
+    def __init__(self, data, endian, pos = 0):
+        self.__data = data
+        self.__endian = endian
+        self.__pos = pos
+
+    def read(self, t):
+        c = t[0]
+        self.__pos += -self.__pos % _dbus_align[c]
+        if c in _dbus_fixed:
+            fmt = self.__endian + _dbus_fixed[c]
+            value = struct.unpack_from(fmt, self.__data, self.__pos)[0]
+            self.__pos += struct.calcsize(fmt)
+            if c == "b":
+                return bool(value)
+            return value
+        elif c == "s" or c == "o" or c == "g":
+            if c == "g":
+                n = ord(self.__data[self.__pos])
+                self.__pos += 1
+            else:
+                n = self.read("u")
+            value = self.__data[self.__pos:self.__pos + n]
+            self.__pos += n + 1
+            if c == "g":
+                return value
+            return value.decode("utf-8")
+        elif c == "v":
+            return self.read(self.read("g"))
+        elif c == "a":
+            n = self.read("u")
+            self.__pos += -self.__pos % _dbus_align[t[1]]
+            end = self.__pos + n
+            items = []
+            while self.__pos < end:
+                items.append(self.read(t[1:]))
+            if t[1] == "{":
+                return dict(items)
+            return items
+        else:
+            return tuple(self.read(sub) for sub in _dbus_split(t[1:-1]))
+
+class _DbusMessage:
+    def __init__(self, msgtype, flags, serial, fields, body):
+        self.type = msgtype
+        self.flags = flags
+        self.serial = serial
+        # {field code: value}
+        self.fields = fields
+        self.body = body
+
+# Returns an encoded message. fields: [(field code, (signature, value))]
+def _dbus_message(msgtype, serial, fields, sig = "", args = (), flags = 0):
+    body = _DbusWriter()
+    for t, v in zip(_dbus_split(sig), args):
+        body.write(t, v)
+    if sig:
+        fields = fields + [(_dbus_signature, ("g", sig))]
+    head = _DbusWriter()
+    head.data.extend(struct.pack("<cBBBII", "l", msgtype, flags, 1, len(body.data), serial))
+    head.write("a(yv)", fields)
+    head.align(8)
+    return str(head.data + body.data)
+
+# Returns the total length of the message starting with these 16 bytes
+def _dbus_message_length(head):
+    endian = head[0] == "B" and ">" or "<"
+    body_len, fields_len = struct.unpack(endian + "I4xI", head[4:16])
+    return 16 + fields_len + (-fields_len % 8) + body_len
+
+def _dbus_parse(data):
+    endian = data[0] == "B" and ">" or "<"
+    msgtype, flags, version, body_len, serial = struct.unpack(endian + "BBBII", data[1:12])
+    head = _DbusReader(data, endian, 12)
+    fields = dict(head.read("a(yv)"))
+    body = []
+    sig = fields.get(_dbus_signature, "")
+    if sig:
+        reader = _DbusReader(data[len(data) - body_len:], endian)
+        body = [reader.read(t) for t in _dbus_split(sig)]
+    return _DbusMessage(msgtype, flags, serial, fields, body)
+
+class DbusError(Exception):
+    def __init__(self, name, message = ""):
+        Exception.__init__(self, "%s: %s" % (name, message))
+        self.name = name
+
+# A connection to a bus, for making method calls and receiving signals from an
+# asyncio event loop. Coroutines (call(), connect(), ...) are run with yield From().
+class AsyncDbus:
+    def __init__(self, loop = None):
+        self.__loop = loop or asyncio.get_event_loop()
+        self.__reader = None
+        self.__writer = None
+        self.__serial = 0
+        # {serial: future for the reply}
+        self.__replies = {}
+        # {(interface, member): [callbacks]}
+        self.__signals = {}
+        self.unique_name = None
+        # done when the connection is lost, or failed with DbusError if it broke
+        self.closed = asyncio.Future(loop=self.__loop)
+
+    # Connects to the bus at 'address', by default the session bus
+    def connect(self, address = None):
+        address = address or os.environ.get("DBUS_SESSION_BUS_ADDRESS", "")
+        path = None
+        for addr in address.split(";"):
+            kind, sep, params = addr.partition(":")
+            params = dict(p.split("=", 1) for p in params.split(",") if "=" in p)
+            if kind == "unix" and "path" in params:
+                path = params["path"]
+            elif kind == "unix" and "abstract" in params:
+                path = "\0" + params["abstract"]
+            if path:
+                break
+        if not path:
+            raise IOError("No usable bus address: %r" % address)
+
+        self.__reader, self.__writer = yield From(asyncio.open_unix_connection(path, loop=self.__loop))
+        self.__writer.write("\0AUTH EXTERNAL %s\r\n" % str(os.getuid()).encode("hex"))
+        line = yield From(self.__reader.readline())
+        if not line.startswith("OK "):
+            raise IOError("Bus authentication failed: %r" % line)
+        self.__writer.write("BEGIN\r\n")
+        asyncio.ensure_future(self.__read_messages(), loop=self.__loop)
+        reply = yield From(self.call(dbus_bus_name, dbus_bus_path, dbus_bus_name, "Hello"))
+        self.unique_name = reply[0]
 
-    loop.run()
+    def close(self):
+        if self.__writer:
+            self.__writer.close()
+
+    def __send(self, msgtype, fields, sig = "", args = (), flags = 0):
+        self.__serial += 1
+        self.__writer.write(_dbus_message(msgtype, self.__serial, fields, sig, args, flags))
+        return self.__serial
+
+    # Calls a method, returning the list of values it returned, or raising DbusError.
+    # autostart: whether the bus may start 'dest' if it isn't running
+    def call(self, dest, path, interface, member, sig = "", args = (), timeout = None, autostart = True):
+        if self.closed.done():
+            raise DbusError("Disconnected")
+        fields = [(_dbus_path, ("o", path)), (_dbus_member, ("s", member)),
+                  (_dbus_destination, ("s", dest))]
+        if interface:
+            fields.append((_dbus_interface, ("s", interface)))
+        serial = self.__send(_dbus_method_call, fields, sig, args,
+                             not autostart and _dbus_no_auto_start or 0)
+        reply = asyncio.Future(loop=self.__loop)
+        self.__replies[serial] = reply
+        try:
+            body = yield From(asyncio.wait_for(reply, timeout, loop=self.__loop))
+        finally:
+            self.__replies.pop(serial, None)
+        raise Return(body)
+
+    # Calls callback(*values) for each matching signal
+    def add_signal_receiver(self, callback, member, interface, arg0 = None):
+        self.__signals.setdefault((interface, member), []).append(callback)
+        rule = "type='signal',interface='%s',member='%s'" % (interface, member)
+        if arg0:
+            rule += ",arg0='%s'" % arg0
+        yield From(self.call(dbus_bus_name, dbus_bus_path, dbus_bus_name, "AddMatch", "s", [rule]))
+
+    def __read_messages(self):
+        try:
+            while True:
+                head = yield From(self.__reader.readexactly(16))
+                rest = yield From(self.__reader.readexactly(_dbus_message_length(head) - 16))
+                self.__dispatch(_dbus_parse(head + rest))
+        except (asyncio.IncompleteReadError, IOError), e:
+            self.__fail(DbusError("Disconnected", str(e)))
+            self.closed.set_result(None)
+        except Exception, e:
+            # eg a message which couldn't be parsed: nothing after it can be trusted either
+            print "D-Bus connection failed: %s: %s" % (e.__class__.__name__, e)
+            self.close()
+            error = DbusError("Failed", "%s: %s" % (e.__class__.__name__, e))
+            self.__fail(error)
+            self.closed.set_exception(error)
+
+    def __fail(self, error):
+        for reply in self.__replies.itervalues():
+            if not reply.done():
+                reply.set_exception(error)
+
+    def __dispatch(self, msg):
+        if msg.type == _dbus_method_return or msg.type == _dbus_error:
+            reply = self.__replies.get(msg.fields.get(_dbus_reply_serial))
+            if not reply or reply.done():
+                # eg timed out
+                return
+            if msg.type == _dbus_error:
+                reply.set_exception(DbusError(msg.fields.get(_dbus_error_name),
+                                              msg.body and msg.body[0] or ""))
+            else:
+                reply.set_result(msg.body)
+        elif msg.type == _dbus_signal:
+            key = (msg.fields.get(_dbus_interface), msg.fields.get(_dbus_member))
+            for callback in self.__signals.get(key, []):
+                try:
+                    callback(*msg.body)
+                except:
+                    print "Signal handler failed: %s" % sys.exc_info()[1]
+        elif msg.type == _dbus_method_call and not msg.flags & _dbus_no_reply_expected:
+            # we don't export anything
+            self.__send(_dbus_error, [(_dbus_error_name, ("s", "org.freedesktop.DBus.Error.UnknownMethod")),
+                                      (_dbus_reply_serial, ("u", msg.serial)),
+                                      (_dbus_destination, ("s", msg.fields.get(_dbus_sender)))],
+                        "s", ["No methods here"])
+
+# Same as query_status(), over an AsyncDbus
+def query_status_async(conn):
+    try:
+        # autostart=False: if banshee is closed, dont start it
+        state = (yield From(conn.call(banshee_status_interface, banshee_status_engine_path,
+                                      banshee_listen_interface, "GetCurrentState",
+                                      timeout=sink_timeout, autostart=False)))[0]
+        if state == "idle" or state == "notready":
+            raise Return((state, None))
+        track = (yield From(conn.call(banshee_status_interface, banshee_status_engine_path,
+                                      banshee_listen_interface, "GetCurrentTrack",
+                                      timeout=sink_timeout, autostart=False)))[0]
+    except DbusError:
+        # banshee isn't running (or went away in the middle)
+        raise Return((None, None))
+    raise Return((state, track))
+
+# Sends statuses to the awesome widget over an AsyncDbus, one call at a time.
+# Statuses which come in meanwhile wait in a bounded queue like QueuedSender's.
+class AsyncDbusSender:
+    def __init__(self, conn, loop, size = sink_queue_size, timeout = sink_timeout):
+        self.__conn = conn
+        self.__loop = loop
+        self.__queue = collections.deque()
+        self.__size = max(1, size)
+        self.__timeout = timeout
+        self.__busy = False
+        self.dropped = 0
+
+    def send(self, sendme):
+        if len(self.__queue) >= self.__size:
+            self.__queue.popleft()
+            self.dropped += 1
+            if stats:
+                stats.count("dropped.dbus")
+        self.__queue.append((sendme, time.time()))
+        if not self.__busy:
+            self.__busy = True
+            asyncio.ensure_future(self.__run(), loop=self.__loop)
+
+    def __run(self):
+        interface = dbus_send_path[1:].replace('/','.')
+        while self.__queue:
+            sendme, queued = self.__queue.popleft()
+            start = time.time()
+            try:
+                err = yield From(self.__conn.call(dbus_send_interface, dbus_send_path, interface,
+                                                  dbus_send_cmd, "s", [sendme], self.__timeout))
+                if err and err[0]:
+                    print err[0]
+                ok = True
+            except (DbusError, asyncio.TimeoutError), e:
+                print "DBus Exception: %s" % (e or "Timed out")
+                ok = False
+            if stats:
+                stats.observe("queue.dbus", start - queued)
+                stats.observe("send.dbus", time.time() - start)
+                stats.count("%s.dbus" % (ok and "sent" or "failed"))
+        self.__busy = False
+
+# Coroutine which listens for changes like cmd_listen() does, but on an asyncio
+# event loop, so that it can share the loop with other things. Runs until the
+# bus connection is lost. address: the bus to use, by default the session bus.
+def listen_async(outputs, track_format = default_track_format, err_format = default_err_format,
+                 loop = None, address = None):
+    loop = loop or asyncio.get_event_loop()
+    senders = [make_sender(o) for o in outputs if o != "dbus"]
+    conn = AsyncDbus(loop)
+    yield From(conn.connect(address))
+    if "dbus" in outputs:
+        senders.append(AsyncDbusSender(conn, loop))
+
+    # only the newest query's result is used, in case they finish out of order
+    latest = [0]
+    def query(done):
+        latest[0] += 1
+        seq = latest[0]
+        def finished(task):
+            if task.exception():
+                print "Status query failed: %s" % task.exception()
+            elif seq == latest[0]:
+                done(*task.result())
+        asyncio.ensure_future(query_status_async(conn), loop=loop).add_done_callback(finished)
+    def timer(ms, callback):
+        loop.call_later(ms / 1000.0, callback)
+    handler = Handler(MultiSender(senders), track_format, err_format, timer, query=query)
+
+    yield From(conn.add_signal_receiver(handler.handle_banshee, banshee_listen_signal, banshee_listen_interface))
+    yield From(conn.add_signal_receiver(handler.handle_state, banshee_state_signal, banshee_listen_interface))
+    yield From(conn.add_signal_receiver(handler.handle_owner, shutdown_listen_signal, shutdown_listen_interface,
+                                        banshee_status_interface))
+
+    #ping the current status before we start listening for changes
+    handler.refresh()
+
+    try:
+        yield From(conn.closed)
+    finally:
+        conn.close()
+
+def cmd_listen_async(outputs, track_format = default_track_format, err_format = default_err_format):
+    try:
+        get_formatter(track_format, err_format)
+        for o in outputs:
+            parse_output(o)
+    except ValueError, e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
+    load_asyncio()
+    loop = asyncio.get_event_loop()
+    if stats:
+        loop.add_signal_handler(signal.SIGUSR1, stats.dump)
+    try:
+        loop.run_until_complete(listen_async(outputs, track_format, err_format, loop))
+    except KeyboardInterrupt:
+        pass
+    except (DbusError, IOError), e:
+        sys.stderr.write("%s\n" % e)
+        loop.close()
+        sys.exit(1)
+    loop.close()
 
 def cmd_status(track_format = default_track_format, err_format = default_err_format):
     print get_status(track_format, err_format)
 
-def cmd_play():
+def do_play():
     banshee = get_dbus_obj(banshee_status_interface, banshee_status_engine_path)
     if banshee:
         banshee.TogglePlaying()
-    cmd_status()
 
-def cmd_stop():
+def do_stop():
     # Don't start banshee to stop it...
     banshee = get_dbus_obj(banshee_status_interface, banshee_status_engine_path, False)
     if banshee:
         banshee.Close()
-    cmd_status()
 
-def cmd_next():
+def do_next():
     # Not sure what the 'restart' bool is for
     banshee = get_dbus_obj(banshee_status_interface, banshee_status_controller_path)
     if banshee:
         banshee.Next(True)
-    cmd_status()
 
-def cmd_prev():
+def do_prev():
     # Not sure what the 'restart' bool is for
     banshee = get_dbus_obj(banshee_status_interface, banshee_status_controller_path)
     if banshee:
         banshee.RestartOrPrevious(True)
+
+controls = {"play": do_play, "stop": do_stop, "next": do_next, "prev": do_prev}
+
+def cmd_play():
+    do_play()
+    cmd_status()
+
+def cmd_stop():
+    do_stop()
+    cmd_status()
+
+def cmd_next():
+    do_next()
+    cmd_status()
+
+def cmd_prev():
+    do_prev()
     cmd_status()
 
 def main(args):
@@ -211,6 +1404,45 @@ def main(args):
         help_exit()
 
     cmd = args[1]
+    if cmd in controls or cmd == "status":
+        # a running daemon can answer without us touching D-Bus
+        try:
+            if cmd == "status" and len(args) == 3:
+                resp = daemon_request(cmd, args[2])
+            else:
+                resp = daemon_request(cmd)
+        except DaemonError, e:
+            # not retried via D-Bus: the daemon might've already done it
+            sys.stderr.write("%s\n" % e)
+            sys.exit(1)
+        if resp is not None:
+            print resp
+            return
+    if cmd == "stats":
+        # only the daemon can be asked
+        try:
+            resp = daemon_request(cmd)
+        except DaemonError, e:
+            sys.stderr.write("%s\n" % e)
+            sys.exit(1)
+        if resp is None:
+            sys.stderr.write("No daemon running, send SIGUSR1 to a listener to have it print its stats.\n")
+            sys.exit(1)
+        print resp
+        return
+    if cmd == "listen_async":
+        if len(args) < 3:
+            help_exit()
+        outputs = args[2].split(",")
+        if len(args) == 5:
+            cmd_listen_async(outputs, args[3], args[4])
+        elif len(args) == 4:
+            cmd_listen_async(outputs, args[3])
+        else:
+            cmd_listen_async(outputs)
+        return
+    load_dbus()
+
     if cmd == "play":
         cmd_play()
     elif cmd == "stop":
@@ -226,18 +1458,35 @@ def main(args):
             cmd_status()
     elif cmd == "listen_print":
         if len(args) == 4:
-            cmd_listen(False, args[2], args[3])
+            cmd_listen(["print"], args[2], args[3])
         if len(args) == 3:
-            cmd_listen(False, args[2])
+            cmd_listen(["print"], args[2])
         else:
-            cmd_listen(False, )
+            cmd_listen(["print"], )
     elif cmd == "listen_dbus":
         if len(args) == 4:
-            cmd_listen(True, args[2], args[3])
+            cmd_listen(["dbus"], args[2], args[3])
         if len(args) == 3:
-            cmd_listen(True, args[2])
+            cmd_listen(["dbus"], args[2])
+        else:
+            cmd_listen(["dbus"])
+    elif cmd == "listen":
+        if len(args) < 3:
+            help_exit()
+        outputs = args[2].split(",")
+        if len(args) == 5:
+            cmd_listen(outputs, args[3], args[4])
+        elif len(args) == 4:
+            cmd_listen(outputs, args[3])
+        else:
+            cmd_listen(outputs)
+    elif cmd == "daemon":
+        if len(args) == 4:
+            cmd_listen([], args[2], args[3], True)
+        elif len(args) == 3:
+            cmd_listen([], args[2], serve=True)
         else:
-            cmd_listen(True)
+            cmd_listen([], serve=True)
     else:
         help_exit()
 
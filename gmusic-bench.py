@@ -0,0 +1,409 @@
+#!/usr/bin/python
+
+# Copyright 2012  Nicholas Parker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+#####
+# DESCRIPTION:
+#  Benchmarks the phases of gmusic-ratings.py against a generated library:
+#  a tree of tagged .mp3/.ogg/.flac files (plus some files to be ignored or
+#  complained about) and a matching cloud library served by FakeApi. Each
+#  phase is timed separately, and the results are written as JSON so that
+#  runs can be compared over time.
+# PREREQUISITES:
+# - Whatever gmusic-ratings.py needs to be imported (mutagen, gmusicapi)
+#####
+
+import bisect
+import getopt
+import imp
+import json
+import os
+import platform
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+### OPTIONS ###
+
+# number of music files to generate (override with -n):
+default_songs = 10000
+# number of distinct artists, and how skewed songs are towards the first few (zipf exponent):
+default_artists = 500
+default_artist_skew = 1.2
+# relative frequency of ratings 0 (unrated) through 5:
+default_rating_weights = [40, 5, 10, 20, 15, 10]
+# relative frequency of each format:
+default_format_weights = {".mp3": 70, ".ogg": 15, ".flac": 15}
+# fraction of extra files with ignored (eg .jpg) or unrecognized extensions:
+default_other_files = 0.05
+# fraction of local songs which are also in the cloud, and how many of those have a stale cloud rating:
+default_cloud_coverage = 0.95
+default_stale_ratings = 0.05
+# fake latency of each rating update request, in seconds:
+default_update_latency = 0.05
+
+script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gmusic-ratings.py")
+
+### FILE GENERATION ###
+
+def _syncsafe(n):
+    return "".join(chr((n >> s) & 0x7f) for s in (21, 14, 7, 0))
+
+# values which gmusic-ratings.py maps back to ratings 1-5
+_popm_ratings = [0, 1, 64, 128, 196, 255]
+_vorbis_ratings = [None, "0.1", "0.3", "0.45", "0.7", "0.9"]
+
+# Returns an ID3v2.4 tag followed by a few (silent) MPEG frames
+def make_mp3(artist, title, rating):
+    def frame(fid, data):
+        return fid + _syncsafe(len(data)) + "\0\0" + data
+    frames = frame("TPE1", "\x03" + artist.encode("utf-8")) + \
+        frame("TIT2", "\x03" + title.encode("utf-8"))
+    if rating:
+        frames += frame("POPM", "banshee\0" + chr(_popm_ratings[rating]) + "\0\0\0\0")
+    frames += "\0" * 256 # padding
+    return "ID3\x04\0\0" + _syncsafe(len(frames)) + frames + ("\xff\xfb\x90\x64" + "\0" * 413) * 4
+
+def _vorbis_comment(artist, title, rating):
+    comments = ["ARTIST=" + artist.encode("utf-8"), "TITLE=" + title.encode("utf-8")]
+    if rating:
+        comments.append("RATING=" + _vorbis_ratings[rating])
+    vendor = "gmusic-bench"
+    return struct.pack("<I", len(vendor)) + vendor + struct.pack("<I", len(comments)) + \
+        "".join(struct.pack("<I", len(c)) + c for c in comments)
+
+# Returns a FLAC file with STREAMINFO, VORBIS_COMMENT and PADDING blocks
+def make_flac(artist, title, rating):
+    # 4096 samples/block, 44.1kHz, 2 channels, 16 bits
+    streaminfo = struct.pack(">HH", 4096, 4096) + "\0" * 6 + \
+        struct.pack(">Q", (44100 << 44) | (1 << 41) | (15 << 36)) + "\0" * 16
+    blocks = [(0, streaminfo), (4, _vorbis_comment(artist, title, rating)), (1, "\0" * 256)]
+    out = "fLaC"
+    for i, (blocktype, data) in enumerate(blocks):
+        if i == len(blocks) - 1:
+            blocktype |= 0x80
+        out += chr(blocktype) + struct.pack(">I", len(data))[1:] + data
+    return out + "\xff\xf8" + "\0" * 1000
+
+_crc_table = []
+for i in xrange(256):
+    r = i << 24
+    for j in xrange(8):
+        if r & 0x80000000:
+            r = (r << 1) ^ 0x04c11db7
+        else:
+            r <<= 1
+    _crc_table.append(r & 0xffffffff)
+
+def _ogg_page(packet, seqno, headertype, granule = 0):
+    # packets in the generated files are always < 255*255 bytes, so fit in one page
+    lacing = [255] * (len(packet) / 255) + [len(packet) % 255]
+    page = "OggS\0" + chr(headertype) + struct.pack("<qIII", granule, 0x62656e63, seqno, 0) + \
+        chr(len(lacing)) + "".join(chr(l) for l in lacing) + packet
+    crc = 0
+    for c in page:
+        crc = ((crc << 8) & 0xffffffff) ^ _crc_table[(crc >> 24) ^ ord(c)]
+    return page[:22] + struct.pack("<I", crc) + page[26:]
+
+# Returns an Ogg Vorbis file with identification, comment and (bogus) setup headers
+def make_ogg(artist, title, rating):
+    ident = "\x01vorbis" + struct.pack("<IBIiii", 0, 2, 44100, 0, 128000, 0) + "\xb8\x01"
+    comment = "\x03vorbis" + _vorbis_comment(artist, title, rating) + "\x01"
+    setup = "\x05vorbis" + "\0" * 64
+    return _ogg_page(ident, 0, 0x02) + _ogg_page(comment, 1, 0) + \
+        _ogg_page(setup, 2, 0) + _ogg_page("\0" * 1000, 3, 0x04, 44100)
+
+_makers = {".mp3": make_mp3, ".ogg": make_ogg, ".flac": make_flac}
+
+# Picks values at random from {value: weight}
+class Weighted:
+    def __init__(self, weights):
+        self.__values = sorted(weights)
+        self.__cumulative = []
+        total = 0
+        for v in self.__values:
+            total += weights[v]
+            self.__cumulative.append(total)
+
+    def pick(self, rand):
+        i = bisect.bisect_left(self.__cumulative, rand.uniform(0, self.__cumulative[-1]))
+        return self.__values[min(i, len(self.__values) - 1)]
+
+# Writes the synthetic library below 'root', as <artist>/<album>/<track>.<ext>.
+# Returns [(artist, title, rating)] for the music files written. With write=False,
+# just returns what would have been written.
+def generate_tree(root, params, rand, write = True):
+    artists = [u"Artist %d \u00e9" % i for i in xrange(params["artists"])]
+    # zipf-ish weights, so a few artists have most of the songs
+    artist_weights = Weighted(dict((i, 1.0 / (i + 1) ** params["artist_skew"])
+                                   for i in xrange(len(artists))))
+    rating_weights = Weighted(dict(enumerate(params["rating_weights"])))
+    format_weights = Weighted(params["format_weights"])
+    songs = []
+    for n in xrange(params["songs"]):
+        artist = artists[artist_weights.pick(rand)]
+        title = u"Song %d" % n
+        rating = rating_weights.pick(rand)
+        ext = format_weights.pick(rand)
+        songs.append((artist, title, rating))
+        d = os.path.join(root, artist.encode("utf-8"), "Album %d" % (n % 7))
+        if write:
+            if not os.path.isdir(d):
+                os.makedirs(d)
+            open(os.path.join(d, "%05d%s" % (n, ext)), "wb").write(
+                _makers[ext](artist, title, rating))
+
+        if rand.random() < params["other_files"]:
+            # mostly ignored extensions, some that get complained about
+            other = rand.choice([".jpg", ".m3u", ".txt", ".nfo", ".m4a", ".wav"])
+            if write:
+                open(os.path.join(d, "extra%05d%s" % (n, other)), "wb").write("\0" * 100)
+    return songs
+
+# Returns a cloud library (list of song dicts) for some of the provided songs,
+# some of them with stale ratings, plus some songs which are only in the cloud.
+def generate_cloud(songs, params, rand):
+    lib = []
+    for i, (artist, title, rating) in enumerate(songs):
+        if rand.random() >= params["cloud_coverage"]:
+            continue
+        if rand.random() < params["stale_ratings"]:
+            rating = (rating + rand.randint(1, 5)) % 6
+        lib.append({"id": "song-%d" % i, "artist": artist, "title": title,
+                    "name": title, "rating": rating})
+    for i in xrange(len(songs) / 100):
+        lib.append({"id": "cloudonly-%d" % i, "artist": u"Cloud Artist",
+                    "title": u"Cloud Song %d" % i, "name": u"Cloud Song %d" % i, "rating": 0})
+    return lib
+
+### BENCHMARK ###
+
+# Runs the gmusic-ratings.py code with its (quite chatty) output discarded
+class Quiet:
+    def __enter__(self):
+        self.__stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.__stdout
+
+class Timer:
+    def __init__(self):
+        self.results = {}
+
+    # Times fn(), storing the wall and cpu seconds under 'name'. Returns fn's result.
+    def time(self, name, fn):
+        sys.stderr.write("%s...\n" % name)
+        wall = time.time()
+        cpu = time.clock()
+        with Quiet():
+            ret = fn()
+        self.results[name] = {"wall": time.time() - wall, "cpu": time.clock() - cpu}
+        return ret
+
+def run(params, workdir):
+    rand = random.Random(params["seed"])
+    gm = imp.load_source("gmusic_ratings", script_path)
+    timer = Timer()
+    counts = {}
+
+    # a tree from an earlier run (-d) is reused if it was generated with the same parameters
+    root = os.path.join(workdir, "music")
+    treeparamsfile = os.path.join(workdir, "music.json")
+    treeparams = json.loads(json.dumps(dict((k, params[k]) for k in
+        ("songs", "artists", "artist_skew", "rating_weights", "format_weights",
+         "other_files", "seed"))))
+    reuse = os.path.isdir(root) and os.path.isfile(treeparamsfile) and \
+        json.load(open(treeparamsfile)) == treeparams
+    if reuse:
+        sys.stderr.write("Reusing %s\n" % root)
+    else:
+        sys.stderr.write("Generating %d songs in %s...\n" % (params["songs"], root))
+        shutil.rmtree(root, True)
+    songs = generate_tree(root, params, rand, not reuse)
+    json.dump(treeparams, open(treeparamsfile, "w"))
+    lib = generate_cloud(songs, params, rand)
+
+    def walk():
+        paths = []
+        for dirpath, dirs, files in os.walk(root):
+            for f in files:
+                paths.append(os.path.join(dirpath, f))
+        return paths
+    paths = timer.time("walk", walk)
+    music = [p for p in paths if p.endswith((".mp3", ".ogg", ".flac"))]
+    counts["files"] = len(paths)
+    counts["music_files"] = len(music)
+
+    def parse():
+        return [gm.SongFiles.read_song(p) for p in music]
+    parsed = timer.time("parse", parse)
+
+    def parse_mutagen():
+        gm.fast_tags = False
+        try:
+            return [gm.SongFiles.read_song(p) for p in music]
+        finally:
+            gm.fast_tags = True
+    timer.time("parse_mutagen", parse_mutagen)
+
+    dbpath = os.path.join(workdir, "bench.db")
+    if os.path.exists(dbpath):
+        os.remove(dbpath)
+    db = gm.LibraryDB(dbpath)
+    def cache_save():
+        entries = []
+        for p, s in zip(music, parsed):
+            st = os.stat(p)
+            s.filename = p.decode("utf-8")
+            entries.append((st.st_size, st.st_mtime, st.st_ino, s))
+        db.put_files(entries)
+    timer.time("cache_save", cache_save)
+    timer.time("cache_load", db.file_stats)
+
+    # full scans through SongFiles: everything cached, then from scratch
+    timer.time("scan_cached", lambda: gm.SongFiles(root, db, 1))
+    db.close()
+    os.remove(dbpath)
+    db = gm.LibraryDB(dbpath)
+    files = timer.time("scan_cold", lambda: gm.SongFiles(root, db, 1))
+    if params["workers"] > 1:
+        db.close()
+        os.remove(dbpath)
+        db = gm.LibraryDB(dbpath)
+        files = timer.time("scan_cold_parallel",
+                           lambda: gm.SongFiles(root, db, params["workers"]))
+
+    def find_rating():
+        found = 0
+        for s in lib:
+            if files.find_rating(s) >= 0:
+                found += 1
+        return found
+    counts["find_rating_found"] = timer.time("find_rating", find_rating)
+    counts["cloud_songs"] = len(lib)
+
+    api = gm.FakeApi(lib)
+    timer.time("cloud_save", lambda: db.merge_cloud(api.get_all_songs()))
+    db.set_meta("cloud_fetched", time.time())
+    timer.time("match", db.match_cloud)
+    changed = timer.time("changed", db.cloud_changed)
+    counts["needs_update"] = len(changed)
+    timer.time("buckets", lambda: [db.cloud_ids(r) for r in (5, 4, 0)])
+
+    rater = timer.time("rater_init", lambda: gm.GMusicRater(files, db, False, 3600, api))
+    timer.time("playlists_initial", rater.sync_playlists)
+    timer.time("playlists_unchanged", rater.sync_playlists)
+    counts["playlist_api_calls"] = sum(api.calls.get(m, 0) for m in
+        ("create_playlist", "add_songs_to_playlist", "remove_songs_from_playlist", "delete_playlist"))
+
+    backend = gm.FakeBackend(latency=params["update_latency"], seed=params["seed"])
+    uploader = gm.BatchUploader(backend, db.set_cloud_ratings, params["concurrency"])
+    timer.time("update", lambda: uploader.run(changed))
+    counts["update_requests"] = uploader.requests
+    counts["update_chunk_size"] = uploader.chunk_size()
+    db.close()
+
+    return {"params": params,
+            "results": timer.results,
+            "counts": counts,
+            "time": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform()}
+
+### MAIN ###
+
+def usage_exit(argv):
+    sys.stderr.write('''Args: %s [options]
+  -n <songs>       number of music files to generate (default %d)
+  -a <artists>     number of distinct artists (default %d)
+  -j <workers>     also time a parallel cold scan with this many processes
+  -c <requests>    concurrent rating update requests (default %d)
+  -l <seconds>     fake latency per rating update request (default %s)
+  -s <seed>        random seed (default 0)
+  -d <dir>         work in (and keep) this directory, rather than a temporary one
+  -o <file>        write JSON results to this file, rather than stdout
+''' % (argv[0], default_songs, default_artists, 4, default_update_latency))
+    sys.exit(1)
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv[1:], "n:a:j:c:l:s:d:o:")
+    except getopt.GetoptError, e:
+        sys.stderr.write("%s\n" % e)
+        usage_exit(argv)
+    if args:
+        usage_exit(argv)
+
+    params = {"songs": default_songs,
+              "artists": default_artists,
+              "artist_skew": default_artist_skew,
+              "rating_weights": default_rating_weights,
+              "format_weights": default_format_weights,
+              "other_files": default_other_files,
+              "cloud_coverage": default_cloud_coverage,
+              "stale_ratings": default_stale_ratings,
+              "update_latency": default_update_latency,
+              "workers": 1,
+              "concurrency": 4,
+              "seed": 0}
+    workdir = None
+    outpath = None
+    try:
+        for k, v in opts:
+            if k == "-n":
+                params["songs"] = int(v)
+            elif k == "-a":
+                params["artists"] = int(v)
+            elif k == "-j":
+                params["workers"] = int(v)
+            elif k == "-c":
+                params["concurrency"] = int(v)
+            elif k == "-l":
+                params["update_latency"] = float(v)
+            elif k == "-s":
+                params["seed"] = int(v)
+            elif k == "-d":
+                workdir = v
+            elif k == "-o":
+                outpath = v
+    except ValueError:
+        usage_exit(argv)
+
+    if workdir:
+        if not os.path.isdir(workdir):
+            os.makedirs(workdir)
+        result = run(params, workdir)
+    else:
+        workdir = tempfile.mkdtemp(prefix="gmusic-bench-")
+        try:
+            result = run(params, workdir)
+        finally:
+            shutil.rmtree(workdir)
+
+    if outpath:
+        out = open(outpath, "w")
+    else:
+        out = sys.stdout
+    json.dump(result, out, indent=2, sort_keys=True)
+    out.write("\n")
+
+if __name__ == "__main__":
+    main(sys.argv)
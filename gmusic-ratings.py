@@ -24,6 +24,9 @@
 # PREREQUISITES:
 # - Mutagen (for reading tag metadata)
 # - gmusicapi (for applying ratings to a GMusic library)
+# - pyinotify (only for watching for changes with -w)
+# - scandir (optional, but makes scanning faster: without it every
+#   directory entry is stat()ed)
 #####
 
 import os
@@ -31,6 +34,180 @@ import sys
 reload(sys) # required for this to work, apparently:
 sys.setdefaultencoding('utf-8')
 import cPickle
+import errno
+import getopt
+import re
+import stat
+import struct
+
+####
+# INSTRUMENTATION
+####
+
+import atexit
+import json
+import threading
+import time
+
+# file to write a JSON report of timings and counts to when exiting, or "" to disable (override with -m):
+metrics_report = ""
+# seconds between progress lines during long phases, or 0 to disable (override with -v):
+progress_interval = 0
+
+# upper bounds (in seconds) of the buckets in latency histograms
+_histogram_buckets = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# A running phase, see Metrics.phase()
+class _Phase:
+    def __init__(self, metrics, name):
+        self.__metrics = metrics
+        self.__name = name
+        self.__wall = time.time()
+        self.__cpu = os.times()
+        self.__stopped = False
+
+    def stop(self):
+        if self.__stopped:
+            return
+        self.__stopped = True
+        cpu = os.times()
+        self.__metrics.add_phase(self.__name, time.time() - self.__wall,
+                                 cpu[0] + cpu[1] - self.__cpu[0] - self.__cpu[1],
+                                 cpu[2] + cpu[3] - self.__cpu[2] - self.__cpu[3])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+# Collects per-phase wall/cpu times, counters and latency histograms, for
+# writing as a JSON report. Safe to use from multiple threads.
+class Metrics:
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__started = time.time()
+        self.__phases = {}
+        self.__counters = {}
+        self.__histograms = {}
+        self.__last_progress = {}
+
+    # Starts timing a phase, returning an object to stop() it (or use in a 'with').
+    # Phases with the same name are added up.
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def add_phase(self, name, wall, cpu, children_cpu):
+        with self.__lock:
+            p = self.__phases.setdefault(name, {"wall": 0.0, "cpu": 0.0, "children_cpu": 0.0, "runs": 0})
+            p["wall"] += wall
+            p["cpu"] += cpu
+            p["children_cpu"] += children_cpu
+            p["runs"] += 1
+
+    def count(self, name, n = 1):
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + n
+
+    def get(self, name):
+        return self.__counters.get(name, 0)
+
+    # Adds a latency (in seconds) to the named histogram
+    def observe(self, name, seconds):
+        with self.__lock:
+            h = self.__histograms.get(name)
+            if not h:
+                h = {"count": 0, "sum": 0.0, "min": seconds, "max": seconds,
+                     "buckets": [0] * (len(_histogram_buckets) + 1)}
+                self.__histograms[name] = h
+            h["count"] += 1
+            h["sum"] += seconds
+            h["min"] = min(h["min"], seconds)
+            h["max"] = max(h["max"], seconds)
+            i = 0
+            while i < len(_histogram_buckets) and seconds > _histogram_buckets[i]:
+                i += 1
+            h["buckets"][i] += 1
+
+    # Prints a progress line for a long phase, at most every progress_interval seconds
+    def progress(self, name, done, total, unit = "files"):
+        if not progress_interval:
+            return
+        now = time.time()
+        last = self.__last_progress.get(name)
+        if last is None:
+            self.__last_progress[name] = (now, done)
+            return
+        if now - last[0] < progress_interval and done < total:
+            return
+        self.__last_progress[name] = (now, done)
+        print "[%s] %d/%d %s (%.0f/s)" % (name, done, total, unit,
+                                        (done - last[1]) / max(now - last[0], 0.001))
+
+    def report(self):
+        with self.__lock:
+            histograms = {}
+            for name, h in self.__histograms.iteritems():
+                buckets = {}
+                for i, n in enumerate(h["buckets"]):
+                    if i < len(_histogram_buckets):
+                        buckets["<=%s" % _histogram_buckets[i]] = n
+                    else:
+                        buckets[">%s" % _histogram_buckets[-1]] = n
+                histograms[name] = {"count": h["count"], "sum": h["sum"],
+                                    "mean": h["sum"] / h["count"],
+                                    "min": h["min"], "max": h["max"],
+                                    "buckets": buckets}
+            # derived rates
+            rates = {}
+            c = self.__counters
+            if "scan.walk" in self.__phases and c.get("scan.files"):
+                rates["scan.walk.files_per_sec"] = c["scan.files"] / max(self.__phases["scan.walk"]["wall"], 0.001)
+            if "scan.parse" in self.__phases and c.get("scan.parsed"):
+                rates["scan.parse.files_per_sec"] = c["scan.parsed"] / max(self.__phases["scan.parse"]["wall"], 0.001)
+            if c.get("scan.files"):
+                rates["scan.cache_hit_rate"] = float(c.get("scan.cache_hits", 0)) / c["scan.files"]
+            if c.get("scan.dirs"):
+                rates["scan.dir_prune_rate"] = float(c.get("scan.dirs_pruned", 0)) / c["scan.dirs"]
+            return {"argv": sys.argv,
+                    "started": self.__started,
+                    "finished": time.time(),
+                    # rounded, which also hides float noise in the os.times() differences
+                    "phases": dict((k, dict((f, round(n, 6) if isinstance(n, float) else n)
+                                         for f, n in v.iteritems()))
+                                   for k, v in self.__phases.iteritems()),
+                    "counters": dict(self.__counters),
+                    "rates": rates,
+                    "histograms": histograms}
+
+    def write_report(self, path):
+        out = open(path, "w")
+        json.dump(self.report(), out, indent=2, sort_keys=True)
+        out.write("\n")
+        out.close()
+
+metrics = Metrics()
+
+# Wraps an api object (eg gmusicapi's Api), timing every method call into the
+# "api.<method>" histogram and counting failures as "api.<method>.errors".
+class TimedApi:
+    def __init__(self, api):
+        self.__api = api
+
+    def __getattr__(self, name):
+        attr = getattr(self.__api, name)
+        if not callable(attr):
+            return attr
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return attr(*args, **kwargs)
+            except:
+                metrics.count("api.%s.errors" % name)
+                raise
+            finally:
+                metrics.observe("api.%s" % name, time.time() - start)
+        return timed
 
 ####
 # READING SONGS FROM DISK
@@ -39,77 +216,554 @@ import cPickle
 # this is just my own personal list of files to not complain about, you may want to add more:
 ignored_exts = [".jpg", ".m3u", ".png", ".txt", ".sfv", ".nfo", ".epub", ".m4a"]
 
+# whether to retry songs that weren't found with approximate matching (override with -f):
+fuzzy_match = False
+# minimum similarity (0.0-1.0) for an approximate match to be accepted:
+fuzzy_threshold = 0.8
+# trigrams shared by more songs than this are too common to be useful for finding candidates:
+fuzzy_max_postings = 5000
+
+# whether to read tags with the built-in reader, falling back to mutagen for
+# anything it doesn't handle. False always uses mutagen:
+fast_tags = True
+# largest tag block (in bytes) the built-in reader will read before giving up:
+fast_tags_max_bytes = 16 * 1024 * 1024
+
+# how long (in seconds) the cached cloud library is used before refreshing it (override with -t):
+cloud_cache_ttl = 24 * 3600
+
+# number of songs to add to or remove from a playlist per request:
+playlist_batch_size = 1000
+
+# whether to skip listing directories whose mtime hasn't changed since the last
+# scan (override with -p). Much faster on slow or network filesystems, but
+# doesn't notice tags edited in place in those directories (which only changes
+# the file's mtime), so only use this if your tagger rewrites files or you're
+# also using -w:
+prune_unchanged_dirs = False
+
+# number of processes to parse tags with (override with -j), 1 parses in-process:
+scan_workers = 1
+# number of files handed to a worker process at a time:
+scan_batch_size = 64
+
 from mutagen.id3 import ID3
 from mutagen.oggvorbis import OggVorbis
 from mutagen.flac import FLAC
 
-class Song:
+# unicode strings can't be intern()ed, so share equal artist names through this instead
+_artists = {}
+
+# Uses __slots__ and a tuple pickle state, since a scan creates (and sends back
+# from worker processes) hundreds of thousands of these: ~half the memory and
+# unpickling time of a plain instance.
+class Song(object):
+    __slots__ = ("filename", "artist", "title", "rating", "gid")
+
     def __init__(self, filename, artist, title, rating):
         self.filename = filename
-        self.artist = artist
+        self.artist = _artists.setdefault(artist, artist)
         self.title = title
         self.rating = rating
         self.gid = ""
 
+    def __getstate__(self):
+        return (self.filename, self.artist, self.title, self.rating, self.gid)
+
+    def __setstate__(self, state):
+        (self.filename, artist, self.title, self.rating, self.gid) = state
+        self.artist = _artists.setdefault(artist, artist)
+
     def printsong(self):
         print "%s\t%s\t%s\t%s\t%s" % \
             (self.filename, self.artist, self.title, self.rating, self.gid)
 
+# "Artist feat. Someone", "Title (feat. Someone)", "Title [ft. Someone]", ...
+_featuring_re = re.compile(
+    r"(?:\s+|\s*[\(\[])(?:feat\.|ft\.|featuring\s|(?<=[\(\[])feat\s).*$",
+    re.IGNORECASE | re.UNICODE)
+_nonword_re = re.compile(r"[\W_]+", re.UNICODE)
+
+# Returns a casefolded copy of an artist or title, with any "featuring" suffix,
+# punctuation and whitespace removed. Falls back to just stripping the
+# punctuation if that leaves nothing (eg a title like "(feat. X)").
+def normalize(name):
+    name = unicode(name).lower()
+    stripped = _nonword_re.sub(u"", _featuring_re.sub(u"", name))
+    if stripped:
+        return stripped
+    return _nonword_re.sub(u"", name)
+
+def _trigrams(key):
+    key = u" %s " % key
+    return set(key[i:i + 3] for i in xrange(len(key) - 2))
+
+music_exts = frozenset([".mp3", ".ogg", ".flac"])
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Returns [(name, path, whether it's a directory)] for the contents of a
+# directory. Symlinks to directories don't count as directories, to match
+# os.walk(). With the scandir module (os.scandir isn't in python 2), the entry
+# types come from the directory listing itself. Without it, every entry is
+# lstat()ed, so listing costs a stat() per file, as it does with os.walk().
+def _list_dir(path):
+    if scandir:
+        return [(e.name, e.path, e.is_dir(follow_symlinks=False)) for e in scandir(path)]
+    ret = []
+    for name in os.listdir(path):
+        p = os.path.join(path, name)
+        ret.append((name, p, stat.S_ISDIR(os.lstat(p).st_mode)))
+    return ret
+
+# Parses a list of filenames in a worker process. Returns [(filename, Song or None, error)].
+def _read_batch(filenames):
+    ret = []
+    for fpath in filenames:
+        try:
+            ret.append((fpath, SongFiles.read_song(fpath), None))
+        except Exception, e:
+            ret.append((fpath, None, "%s: %s" % (e.__class__.__name__, e)))
+    return ret
+
 class SongFiles:
-    def __init__(self, path):
-        self.__by_artist = {}
-
-        cachefile = "musicfiles.pickle"
-        if os.path.isfile(cachefile):
-            print "Loading cached files..."
-            infile = open(cachefile, "rb")
-            self.__by_artist = cPickle.load(infile)
-            total_found = 0
-            for k,v in self.__by_artist.iteritems():
-                total_found += len(v)
-            print "Found %d music files (%d artists)." % \
-                (total_found, len(self.__by_artist))
-            return
+    def __init__(self, path, db, workers = scan_workers, prune = prune_unchanged_dirs):
+        # eg "lib/" -> "lib", to match the directories of the cached files
+        path = os.path.normpath(path)
+        self.__db = db
+        # built on first use by find_rating_fuzzy()
+        self.__fuzzy_keys = None
+        self.__fuzzy_grams = None
+
+        # only files which were added or changed since the last run are parsed again
+        print "Loading cached files..."
+        phase = metrics.phase("scan.cache_load")
+        cache = db.file_stats()
+        # {dir: (mtime, [subdirs])} as of the last scan
+        dirs = db.dir_stats()
+        phase.stop()
+        if prune:
+            # files by directory, to account for those in directories which are skipped
+            by_dir = {}
+            for p in cache:
+                by_dir.setdefault(os.path.dirname(p), []).append(p)
+        ignored = frozenset(ignored_exts)
 
-        def ignored(filename):
-            for i in ignored_exts:
-                if filename.endswith(i):
-                    return True
-            return False
-        def add(song):
-            if not self.__by_artist.has_key(song.artist):
-                self.__by_artist[song.artist] = []
-            self.__by_artist[song.artist].append(song)
+        # Keeps the cached files below a directory which couldn't be read this
+        # time, rather than dropping them as if they'd been deleted
+        def keep_under(dkey):
+            prefix = dkey.rstrip(u"/") + u"/"
+            kept = [p for p in cache if p.startswith(prefix)]
+            for p in kept:
+                del cache[p]
+            return len(kept)
 
         print "Scanning filesystem..."
-        total_found = 0
-        for root, dirs, files in os.walk(path):
-            for f in files:
-                fpath = os.path.join(root, f)
-                if f.endswith(".mp3"):
-                    add(SongFiles.__song_id3(fpath))
-                elif f.endswith(".ogg") or f.endswith(".flac"):
-                    try:
-                        add(SongFiles.__song_ogg(fpath))
-                    except:
-                        add(SongFiles.__song_flac(fpath))
-                elif not ignored(f):
-                    print "Unrecognized filename extension: %s" % fpath
+        phase = metrics.phase("scan.walk")
+        newdirs = []
+        stats = {}
+        toparse = []
+        hits = 0
+        misses = 0
+        reparsed = 0
+        pruned = 0
+        stack = [(path, None)]
+        while stack:
+            dpath, parent = stack.pop()
+            try:
+                dkey = dpath.decode("utf-8")
+            except UnicodeDecodeError:
+                print "Skipping non-UTF-8 directory: %r" % dpath
+                continue
+            try:
+                # before listing, so that anything changed while listing shows up next time
+                dmtime = os.stat(dpath).st_mtime
+                entries = None
+                recorded = dirs.get(dkey)
+                if not (prune and recorded and recorded[0] == dmtime):
+                    entries = _list_dir(dpath)
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    # removed since it was found: its files are dropped below
+                    print "Couldn't list %s: %s" % (dpath, e)
+                    continue
+                kept = keep_under(dkey)
+                print "Couldn't list %s: %s (keeping %d files found there before)" % (dpath, e, kept)
+                hits += kept
+                # recorded without an mtime, so that it's listed again next time even with prune
+                newdirs.append((dkey, parent, None))
+                continue
+            newdirs.append((dkey, parent, dmtime))
+
+            if entries is None:
+                # nothing was added, removed or renamed in here since the last scan
+                for p in by_dir.get(dkey, []):
+                    if cache.pop(p, None):
+                        hits += 1
+                for d in recorded[1]:
+                    stack.append((d.encode("utf-8"), dkey))
+                pruned += 1
+                continue
+
+            for name, fpath, isdir in entries:
+                if isdir:
+                    stack.append((fpath, dkey))
+                    continue
+                ext = os.path.splitext(name)[1]
+                if not ext in music_exts:
+                    # os.path.isdir(): symlinks to directories aren't followed, or complained about
+                    if not ext in ignored and not os.path.isdir(fpath):
+                        print "Unrecognized filename extension: %s" % fpath
                     continue
-                total_found += 1
-        print "Found %d music files." % total_found
+                try:
+                    st = os.stat(fpath)
+                except OSError, e:
+                    print "Couldn't stat %s: %s" % (fpath, e)
+                    continue
+
+                # unicode paths, to match those read back from the database
+                try:
+                    key = fpath.decode("utf-8")
+                except UnicodeDecodeError:
+                    print "Skipping non-UTF-8 filename: %r" % fpath
+                    continue
+                cached = cache.pop(key, None)
+                if cached and cached == (st.st_size, st.st_mtime, st.st_ino):
+                    hits += 1
+                    continue
+                if cached:
+                    reparsed += 1
+                else:
+                    misses += 1
+                stats[fpath] = (key, st.st_size, st.st_mtime, st.st_ino)
+                toparse.append(fpath)
+            metrics.progress("scan.walk", len(newdirs), len(newdirs) + len(stack), "dirs")
+        phase.stop()
+        phase = metrics.phase("scan.cache_save")
+        db.put_dirs(newdirs)
+        if prune:
+            print "Skipped listing %d of %d unchanged directories." % (pruned, len(newdirs))
+        # whatever's left wasn't found on disk anymore
+        dropped = len(cache)
+        if dropped:
+            db.delete_files(cache.iterkeys())
+        phase.stop()
+
+        if toparse:
+            print "Parsing %d files (%d workers)..." % (len(toparse), workers)
+        batches = [toparse[i:i + scan_batch_size]
+                   for i in xrange(0, len(toparse), scan_batch_size)]
+        if workers > 1 and len(batches) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(workers)
+            results = pool.imap_unordered(_read_batch, batches)
+        else:
+            pool = None
+            results = (_read_batch(b) for b in batches)
+        failed = 0
+        done = 0
+        phase = metrics.phase("scan.parse")
+        try:
+            for batch in results:
+                entries = []
+                for fpath, song, err in batch:
+                    if err:
+                        # not stored, so it's retried on the next run
+                        print "Couldn't read %s: %s" % (fpath, err)
+                        metrics.count("scan.unreadable%s" % (os.path.splitext(fpath)[1].lower() or ".none"))
+                        failed += 1
+                        continue
+                    song.filename = stats[fpath][0]
+                    entries.append(stats[fpath][1:] + (song,))
+                # commit as we go, so that an interrupted scan isn't lost
+                # (this time is also included in scan.parse)
+                with metrics.phase("scan.cache_save"):
+                    db.put_files(entries)
+                done += len(batch)
+                metrics.progress("scan.parse", done, len(toparse))
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+            phase.stop()
 
-        print "Writing..."
-        outfile = open(cachefile, "wb+")
-        cPickle.dump(self.__by_artist, outfile)
+        print "Found %d music files (%d artists)." % db.count_files()
+        print "Cache: %d hits, %d new, %d reparsed, %d dropped, %d unreadable." % \
+            (hits, misses, reparsed, dropped, failed)
+        metrics.count("scan.files", hits + misses + reparsed)
+        metrics.count("scan.cache_hits", hits)
+        metrics.count("scan.new", misses)
+        metrics.count("scan.reparsed", reparsed)
+        metrics.count("scan.dropped", dropped)
+        metrics.count("scan.parsed", len(toparse))
+        metrics.count("scan.unreadable", failed)
+        metrics.count("scan.dirs", len(newdirs))
+        metrics.count("scan.dirs_pruned", pruned)
 
     def find_rating(self, gm):
-        found = False
-        matching_artist = self.__by_artist.get(gm["artist"], [])
-        for s in matching_artist:
-            if s.title == gm["name"]:
-                return s.rating
-        return -1
+        r = self.__db.file_rating(normalize(gm["artist"]), normalize(gm["name"]))
+        if r is None:
+            return -1
+        return r
+
+    # Slower, approximate version of find_rating(), meant to be used only for the
+    # songs which find_rating() couldn't find. Compares trigrams of the combined
+    # artist+title against those of every local song sharing a rare trigram.
+    def find_rating_fuzzy(self, gm, threshold = fuzzy_threshold):
+        if self.__fuzzy_keys is None:
+            self.__build_fuzzy_index()
+        query = _trigrams(u"%s %s" % (normalize(gm["artist"]), normalize(gm["name"])))
+
+        # count shared trigrams per candidate, skipping trigrams that are too common
+        shared = {}
+        for g in query:
+            postings = self.__fuzzy_grams.get(g)
+            if not postings or len(postings) > fuzzy_max_postings:
+                continue
+            for i in postings:
+                shared[i] = shared.get(i, 0) + 1
+
+        best_score = 0
+        best = None
+        for i in sorted(shared, key=shared.get, reverse=True)[:10]:
+            key = self.__fuzzy_keys[i]
+            grams = _trigrams(u"%s %s" % key)
+            # dice coefficient
+            score = 2.0 * len(query & grams) / (len(query) + len(grams))
+            if score > best_score:
+                best_score = score
+                best = i
+        if best is None or best_score < threshold:
+            return -1
+        return self.__fuzzy_ratings[best]
+
+    def __build_fuzzy_index(self):
+        self.__fuzzy_keys = []
+        self.__fuzzy_ratings = []
+        self.__fuzzy_grams = {}
+        for i, (nartist, ntitle, rating) in enumerate(self.__db.file_keys()):
+            self.__fuzzy_keys.append((nartist, ntitle))
+            self.__fuzzy_ratings.append(rating)
+            for g in _trigrams(u"%s %s" % (nartist, ntitle)):
+                self.__fuzzy_grams.setdefault(g, []).append(i)
+
+    # Returns a Song for the provided .mp3/.ogg/.flac file, or raises on parse errors
+    @staticmethod
+    def read_song(filename):
+        # small explicit buffer: network filesystems can report a st_blksize of 1MB+
+        f = open(filename, "rb", 4096)
+        try:
+            magic = f.read(4)
+            f.seek(0)
+            tags = None
+            if fast_tags:
+                try:
+                    if magic[:3] == "ID3" and filename.endswith(".mp3"):
+                        tags = SongFiles.__fast_id3(f)
+                    elif magic == "fLaC":
+                        tags = SongFiles.__fast_flac(f)
+                    elif magic == "OggS":
+                        tags = SongFiles.__fast_ogg(f)
+                except (IOError, struct.error, UnicodeError, ValueError):
+                    tags = None
+        finally:
+            f.close()
+        if tags:
+            return Song(filename, tags[0], tags[1], tags[2])
+
+        # let mutagen deal with it
+        if magic == "fLaC":
+            return SongFiles.__song_flac(filename)
+        elif magic == "OggS":
+            return SongFiles.__song_ogg(filename)
+        elif filename.endswith(".mp3"):
+            return SongFiles.__song_id3(filename)
+        try:
+            return SongFiles.__song_ogg(filename)
+        except:
+            return SongFiles.__song_flac(filename)
+
+    # Reads (artist, title, rating) from the TPE1/TIT2/POPM frames of an ID3v2.3/2.4
+    # tag, seeking past all other frames. Returns None for anything unusual
+    # (v2.2, unsynchronisation, extended headers, compressed frames, ...).
+    @staticmethod
+    def __fast_id3(f):
+        header = f.read(10)
+        if len(header) < 10:
+            return None
+        major = ord(header[3])
+        flags = ord(header[5])
+        if major not in (3, 4) or flags & 0xc0:
+            return None
+        end = 10 + SongFiles.__syncsafe(header[6:10])
+
+        found = {}
+        pos = 10
+        while pos + 10 <= end and len(found) < 3:
+            fheader = f.read(10)
+            if len(fheader) < 10 or fheader[0] == "\0":
+                break # padding
+            fid = fheader[:4]
+            if not fid.isalnum():
+                return None
+            if major == 4:
+                fsize = SongFiles.__syncsafe(fheader[4:8])
+            else:
+                fsize = struct.unpack(">I", fheader[4:8])[0]
+            pos += 10 + fsize
+            if pos > end:
+                return None
+            if not fid in ("TPE1", "TIT2", "POPM") or fid in found:
+                f.seek(fsize, 1)
+                continue
+            # compressed/encrypted/grouped/unsynchronised/length-prefixed frame data
+            if (major == 4 and ord(fheader[9]) & 0x4f) or (major == 3 and ord(fheader[9]) & 0xe0):
+                return None
+            data = f.read(fsize)
+            if len(data) < fsize:
+                return None
+            found[fid] = data
+
+        rating = 0
+        popm = found.get("POPM")
+        if popm:
+            # owner email, NUL, rating byte, play counter
+            sep = popm.find("\0")
+            if sep >= 0 and sep + 1 < len(popm):
+                rating = SongFiles.__adjust_rating_popm(ord(popm[sep + 1]))
+        return (SongFiles.__id3_text(found.get("TPE1")),
+                SongFiles.__id3_text(found.get("TIT2")),
+                rating)
+
+    @staticmethod
+    def __syncsafe(data):
+        b = [ord(c) for c in data]
+        return (b[0] << 21) | (b[1] << 14) | (b[2] << 7) | b[3]
+
+    # Returns the first value in an ID3 text frame
+    @staticmethod
+    def __id3_text(data):
+        if not data:
+            return u""
+        encoding = ord(data[0])
+        if encoding == 0:
+            text = data[1:].decode("latin-1")
+        elif encoding == 1:
+            text = data[1:].decode("utf-16")
+        elif encoding == 2:
+            text = data[1:].decode("utf-16-be")
+        elif encoding == 3:
+            text = data[1:].decode("utf-8")
+        else:
+            raise ValueError("Unknown ID3 text encoding %d" % encoding)
+        return text.split(u"\0", 1)[0]
+
+    # Reads (artist, title, rating) from the VORBIS_COMMENT metadata block of a
+    # FLAC file, seeking past all other metadata blocks (eg embedded pictures).
+    @staticmethod
+    def __fast_flac(f):
+        f.seek(4)
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                return None
+            last = ord(header[0]) & 0x80
+            blocktype = ord(header[0]) & 0x7f
+            size = struct.unpack(">I", "\0" + header[1:])[0]
+            if blocktype == 4:
+                if size > fast_tags_max_bytes:
+                    return None
+                data = f.read(size)
+                if len(data) < size:
+                    return None
+                return SongFiles.__vorbis_comments(data)
+            if last:
+                return (u"", u"", 0)
+            f.seek(size, 1)
+
+    # Reads (artist, title, rating) from the comment header, the second packet of
+    # an Ogg Vorbis stream. Only reads as many pages as that packet spans.
+    @staticmethod
+    def __fast_ogg(f):
+        packets = []
+        packet = []
+        packetsize = 0
+        serial = None
+        while len(packets) < 2:
+            header = f.read(27)
+            if len(header) < 27 or header[:4] != "OggS":
+                return None
+            pageserial = header[14:18]
+            if serial is None:
+                serial = pageserial
+            elif pageserial != serial:
+                return None # multiplexed streams
+            lacing = [ord(c) for c in f.read(ord(header[26]))]
+            data = f.read(sum(lacing))
+            offset = 0
+            for seg in lacing:
+                packet.append(data[offset:offset + seg])
+                offset += seg
+                packetsize += seg
+                if packetsize > fast_tags_max_bytes:
+                    return None
+                if seg < 255:
+                    packets.append("".join(packet))
+                    packet = []
+                    packetsize = 0
+                    if len(packets) == 2:
+                        break
+        if packets[0][:7] != "\x01vorbis" or packets[1][:7] != "\x03vorbis":
+            return None # eg Opus or FLAC-in-Ogg
+        return SongFiles.__vorbis_comments(packets[1][7:])
+
+    # Returns (artist, title, rating) from a Vorbis comment block
+    @staticmethod
+    def __vorbis_comments(data):
+        (vendorlen,) = struct.unpack_from("<I", data, 0)
+        offset = 4 + vendorlen
+        (count,) = struct.unpack_from("<I", data, offset)
+        offset += 4
+        artist = None
+        title = None
+        rating = None
+        for i in xrange(count):
+            (length,) = struct.unpack_from("<I", data, offset)
+            offset += 4
+            if offset + length > len(data):
+                raise ValueError("Truncated Vorbis comment")
+            comment = data[offset:offset + length]
+            offset += length
+            key, sep, value = comment.partition("=")
+            key = key.lower()
+            if key == "artist" and artist is None:
+                artist = value.decode("utf-8")
+            elif key == "title" and title is None:
+                title = value.decode("utf-8")
+            elif key.startswith("rating") and rating is None:
+                rating = SongFiles.__adjust_rating_ogg(float(value))
+        return (artist or u"", title or u"", rating or 0)
+
+    @staticmethod
+    def __adjust_rating_popm(rating):
+        if rating == 0:
+            return 0
+        elif rating < 64:
+            return 1
+        elif rating < 128:
+            return 2
+        elif rating < 192:
+            return 3
+        elif rating < 255:
+            return 4
+        else:
+            return 5
 
     @staticmethod
     def __song_id3(filename):
@@ -119,19 +773,7 @@ class SongFiles:
         rating = 0
         for k,v in f.iteritems():
             if k.startswith("POPM"):
-                rating = v.rating
-                if rating == 0:
-                    pass
-                elif rating < 64:
-                    rating = 1
-                elif rating < 128:
-                    rating = 2
-                elif rating < 192:
-                    rating = 3
-                elif rating < 255:
-                    rating = 4
-                else:
-                    rating = 5
+                rating = SongFiles.__adjust_rating_popm(v.rating)
                 break
         return Song(filename, artist, title, rating)
 
@@ -174,53 +816,503 @@ class SongFiles:
                 break
         return Song(filename, artist, title, rating)
 
+####
+# LIBRARY DATABASE
+####
+
+import sqlite3
+
+# sqlite database holding both the scanned files and the cloud library:
+library_db = "library.db"
+
+# Caches from older versions, imported into the database on first run:
+legacy_files_cache = "musicfiles.pickle"
+legacy_cloud_cache = "gmusic.pickle"
+
+# Wraps the sqlite database which caches both sides of the sync:
+# - files: one row per scanned file, with the stat() values used to detect changes
+# - dirs: one row per scanned directory, with its parent and mtime
+# - cloud: one row per cloud song, with the (pickled) song dict as returned by
+#   the api, and the rating of the matching local file (if any) in local_rating
+# - playlists/playlist_songs: the id and contents of the playlists we manage,
+#   as of the last time we changed them
+# - meta: misc values, eg when the cloud library was last fetched
+class LibraryDB:
+    def __init__(self, path = library_db):
+        self.__conn = sqlite3.connect(path)
+        self.__conn.execute("PRAGMA journal_mode=WAL")
+        self.__conn.execute("PRAGMA synchronous=NORMAL")
+        with self.__conn:
+            self.__conn.executescript('''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY, size INTEGER, mtime REAL, inode INTEGER,
+    artist TEXT, title TEXT, rating INTEGER, nartist TEXT, ntitle TEXT);
+CREATE INDEX IF NOT EXISTS files_match ON files (nartist, ntitle);
+CREATE INDEX IF NOT EXISTS files_rating ON files (rating);
+CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtime REAL);
+CREATE TABLE IF NOT EXISTS cloud (
+    id TEXT PRIMARY KEY, artist TEXT, title TEXT, rating INTEGER,
+    nartist TEXT, ntitle TEXT, local_rating INTEGER, song BLOB);
+CREATE INDEX IF NOT EXISTS cloud_match ON cloud (nartist, ntitle);
+CREATE INDEX IF NOT EXISTS cloud_local_rating ON cloud (local_rating);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+CREATE TABLE IF NOT EXISTS playlists (name TEXT PRIMARY KEY, id TEXT);
+CREATE TABLE IF NOT EXISTS playlist_songs (
+    name TEXT, song TEXT, PRIMARY KEY (name, song));
+''')
+
+    def close(self):
+        self.__conn.close()
+
+    # Imports caches written by older versions, if the database doesn't have anything yet
+    def import_legacy(self):
+        if os.path.isfile(legacy_files_cache) and self.count_files()[0] == 0:
+            print "Importing %s..." % legacy_files_cache
+            try:
+                cache = cPickle.load(open(legacy_files_cache, "rb"))
+                # {filename: (size, mtime, inode, Song)}, older ones can't be validated
+                if cache and isinstance(cache.itervalues().next(), tuple):
+                    self.put_files(cache.itervalues())
+            except Exception, e:
+                print "Skipping unreadable %s: %s" % (legacy_files_cache, e)
+        if os.path.isfile(legacy_cloud_cache) and not self.has_cloud():
+            print "Importing %s..." % legacy_cloud_cache
+            try:
+                self.merge_cloud(cPickle.load(open(legacy_cloud_cache, "rb")))
+                self.set_meta("cloud_fetched", os.path.getmtime(legacy_cloud_cache))
+            except Exception, e:
+                print "Skipping unreadable %s: %s" % (legacy_cloud_cache, e)
+
+    # Returns {path: (size, mtime, inode)} for all scanned files
+    def file_stats(self):
+        ret = {}
+        for row in self.__conn.execute("SELECT path, size, mtime, inode FROM files"):
+            ret[row[0]] = row[1:]
+        return ret
+
+    # Returns {path: (mtime, [subdirectory paths])} for all scanned directories
+    def dir_stats(self):
+        ret = {}
+        rows = self.__conn.execute("SELECT path, parent, mtime FROM dirs").fetchall()
+        for path, parent, mtime in rows:
+            ret[path] = (mtime, [])
+        for path, parent, mtime in rows:
+            if parent in ret:
+                ret[parent][1].append(path)
+        return ret
+
+    # Replaces all directories with an iterable of (path, parent path, mtime)
+    def put_dirs(self, dirs):
+        with self.__conn:
+            self.__conn.execute("DELETE FROM dirs")
+            self.__conn.executemany("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", dirs)
+
+    # Adds or replaces files from an iterable of (size, mtime, inode, Song), in one transaction
+    def put_files(self, entries):
+        with self.__conn:
+            self.__conn.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                ((s.filename, size, mtime, inode, s.artist, s.title, s.rating,
+                  normalize(s.artist), normalize(s.title))
+                 for size, mtime, inode, s in entries))
+
+    # Deletes files by path. Returns the set of (nartist, ntitle) of the deleted files.
+    def delete_files(self, paths):
+        keys = set()
+        with self.__conn:
+            for p in paths:
+                row = self.__conn.execute("SELECT nartist, ntitle FROM files WHERE path = ?",
+                                          (p,)).fetchone()
+                if row:
+                    keys.add(row)
+                    self.__conn.execute("DELETE FROM files WHERE path = ?", (p,))
+        return keys
+
+    # Deletes all files below a directory. Returns the set of (nartist, ntitle) of the deleted files.
+    def delete_files_under(self, dirpath):
+        # everything starting with "dirpath/": "0" is the character after "/"
+        bounds = (dirpath.rstrip(u"/") + u"/", dirpath.rstrip(u"/") + u"0")
+        with self.__conn:
+            keys = set(self.__conn.execute(
+                "SELECT nartist, ntitle FROM files WHERE path >= ? AND path < ?", bounds))
+            self.__conn.execute("DELETE FROM files WHERE path >= ? AND path < ?", bounds)
+        return keys
+
+    # Returns (number of files, number of distinct artists)
+    def count_files(self):
+        return self.__conn.execute(
+            "SELECT COUNT(*), COUNT(DISTINCT nartist) FROM files").fetchone()
+
+    # Returns the rating of a file matching the normalized artist/title, or None.
+    # On duplicates, the first path wins.
+    def file_rating(self, nartist, ntitle):
+        row = self.__conn.execute(
+            "SELECT rating FROM files WHERE nartist = ? AND ntitle = ? ORDER BY path LIMIT 1",
+            (nartist, ntitle)).fetchone()
+        if row:
+            return row[0]
+        return None
+
+    # Returns [(nartist, ntitle, rating)] for all distinct normalized artist/title pairs
+    def file_keys(self):
+        return self.__conn.execute(
+            "SELECT nartist, ntitle, rating FROM files GROUP BY nartist, ntitle").fetchall()
+
+    def has_cloud(self):
+        return self.__conn.execute("SELECT 1 FROM cloud LIMIT 1").fetchone() is not None
+
+    def get_meta(self, key, default = None):
+        row = self.__conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        if row:
+            return row[0]
+        return default
+
+    def set_meta(self, key, value):
+        with self.__conn:
+            self.__conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    # Merges song dicts into the cloud library, then removes the songs with the
+    # ids in 'removed', or if that's None, all songs which weren't in 'songs'.
+    # Only rows which actually changed are rewritten. Returns (added, changed, removed).
+    def merge_cloud(self, songs, removed = None):
+        added = 0
+        changed = 0
+        seen = set()
+        with self.__conn:
+            for s in songs:
+                seen.add(s["id"])
+                blob = cPickle.dumps(s, cPickle.HIGHEST_PROTOCOL)
+                row = self.__conn.execute("SELECT song FROM cloud WHERE id = ?",
+                                          (s["id"],)).fetchone()
+                if row and str(row[0]) == blob:
+                    continue
+                if row:
+                    changed += 1
+                else:
+                    added += 1
+                self.__conn.execute(
+                    "INSERT OR REPLACE INTO cloud VALUES (?, ?, ?, ?, ?, ?, NULL, ?)",
+                    (s["id"], s["artist"], s["title"], s["rating"],
+                     normalize(s["artist"]), normalize(s["name"]), sqlite3.Binary(blob)))
+            if removed is None:
+                removed = [row[0] for row in self.__conn.execute("SELECT id FROM cloud")
+                           if not row[0] in seen]
+            count = 0
+            for i in removed:
+                count += self.__conn.execute("DELETE FROM cloud WHERE id = ?", (i,)).rowcount
+        return (added, changed, count)
+
+    # Matches cloud songs against the files, setting local_rating to the matching
+    # file's rating, or NULL if there's no match. Matches all cloud songs, or
+    # only those with the provided (nartist, ntitle)s.
+    def match_cloud(self, keys = None):
+        update = '''
+UPDATE cloud SET local_rating = (
+    SELECT rating FROM files
+    WHERE files.nartist = cloud.nartist AND files.ntitle = cloud.ntitle
+    ORDER BY path LIMIT 1)'''
+        with self.__conn:
+            if keys is None:
+                self.__conn.execute(update)
+            else:
+                self.__conn.executemany(update + " WHERE nartist = ? AND ntitle = ?", keys)
+
+    # Sets local_rating from an iterable of (id, rating)
+    def set_local_ratings(self, ratings):
+        with self.__conn:
+            self.__conn.executemany("UPDATE cloud SET local_rating = ? WHERE id = ?",
+                                    ((r, i) for i, r in ratings))
+
+    # Returns (number of matched cloud songs, [unmatched song dicts])
+    def cloud_matches(self):
+        found = self.__conn.execute(
+            "SELECT COUNT(*) FROM cloud WHERE local_rating IS NOT NULL").fetchone()[0]
+        notfound = [cPickle.loads(str(row[0])) for row in self.__conn.execute(
+            "SELECT song FROM cloud WHERE local_rating IS NULL")]
+        return (found, notfound)
+
+    # Returns the song dicts whose local rating differs from the cloud rating,
+    # with "rating" set to the local rating
+    def cloud_changed(self):
+        ret = []
+        for song, r in self.__conn.execute(
+                "SELECT song, local_rating FROM cloud WHERE local_rating != rating"):
+            s = cPickle.loads(str(song))
+            s["rating"] = r
+            ret.append(s)
+        return ret
+
+    # Stores the ratings in the provided song dicts as their cloud ratings
+    def set_cloud_ratings(self, songs):
+        with self.__conn:
+            self.__conn.executemany(
+                "UPDATE cloud SET rating = ?, song = ? WHERE id = ?",
+                ((s["rating"], sqlite3.Binary(cPickle.dumps(s, cPickle.HIGHEST_PROTOCOL)), s["id"])
+                 for s in songs))
+
+    # Returns the ids of all cloud songs whose local file has the provided rating
+    def cloud_ids(self, rating):
+        return [row[0] for row in self.__conn.execute(
+            "SELECT id FROM cloud WHERE local_rating = ? ORDER BY id", (rating,))]
+
+    # Returns (playlist id, set of song ids) as last stored, or (None, empty set)
+    def get_playlist(self, name):
+        row = self.__conn.execute("SELECT id FROM playlists WHERE name = ?", (name,)).fetchone()
+        if not row:
+            return (None, set())
+        return (row[0], set(r[0] for r in self.__conn.execute(
+            "SELECT song FROM playlist_songs WHERE name = ?", (name,))))
+
+    # Forgets any previous contents of the named playlist, then stores its id
+    def set_playlist(self, name, pid):
+        with self.__conn:
+            self.__conn.execute("DELETE FROM playlist_songs WHERE name = ?", (name,))
+            self.__conn.execute("INSERT OR REPLACE INTO playlists VALUES (?, ?)", (name, pid))
+
+    def add_playlist_songs(self, name, songids):
+        with self.__conn:
+            self.__conn.executemany("INSERT OR IGNORE INTO playlist_songs VALUES (?, ?)",
+                                    ((name, i) for i in songids))
+
+    def remove_playlist_songs(self, name, songids):
+        with self.__conn:
+            self.__conn.executemany("DELETE FROM playlist_songs WHERE name = ? AND song = ?",
+                                    ((name, i) for i in songids))
+
+####
+# UPLOADING RATING CHANGES
+####
+
+import heapq
+import Queue
+import random
+
+# number of change_song_metadata requests to have in flight at once (override with -c):
+upload_concurrency = 4
+# number of songs per request to start with, and the range it's adjusted within:
+upload_chunk_size = 100
+upload_chunk_min = 10
+upload_chunk_max = 1000
+# requests faster than this (in seconds) grow the chunk size, slower ones shrink it:
+upload_target_latency = 2.0
+# number of times a failed chunk is retried before giving up on its songs:
+upload_retries = 5
+# base delay (in seconds) before a retry, doubled with each attempt:
+upload_backoff = 1.0
+
+# Backends for BatchUploader. A backend just needs an update(songs) method,
+# which applies the provided song dicts or raises an exception.
+
+# Sends updates to a gmusicapi Api (or FakeApi)
+class GMusicBackend:
+    def __init__(self, api):
+        self.__api = api
+
+    def update(self, songs):
+        self.__api.change_song_metadata(songs)
+
+# Pretends to apply updates, taking latency + per_song * len(songs) seconds
+# (+/- jitter) per request. Fails failure_rate of requests at random, and
+# every request with more than max_chunk songs. Applied songs end up in self.updated.
+class FakeBackend:
+    def __init__(self, latency = 0.05, per_song = 0.001, jitter = 0.2,
+                 failure_rate = 0.0, max_chunk = None, seed = None):
+        self.__latency = latency
+        self.__per_song = per_song
+        self.__jitter = jitter
+        self.__failure_rate = failure_rate
+        self.__max_chunk = max_chunk
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.updated = {}
+        self.requests = 0
+        self.failures = 0
+
+    def update(self, songs):
+        with self.__lock:
+            self.requests += 1
+            scale = 1 + self.__random.uniform(-self.__jitter, self.__jitter)
+            fail = self.__random.random() < self.__failure_rate
+        time.sleep(max(0, (self.__latency + self.__per_song * len(songs)) * scale))
+        if fail or (self.__max_chunk and len(songs) > self.__max_chunk):
+            with self.__lock:
+                self.failures += 1
+            raise Exception("Fake failure for %d songs" % len(songs))
+        with self.__lock:
+            for s in songs:
+                self.updated[s["id"]] = s["rating"]
+
+# Sends song updates to a backend in chunks, with up to 'concurrency' chunks in
+# flight at once. The chunk size grows additively while requests complete within
+# the target latency, and shrinks when they're slower or fail. Failed chunks are
+# retried with exponential backoff. on_done(songs) is called (from the thread
+# calling run()) for every chunk as soon as it's applied, so that progress can
+# be checkpointed.
+class BatchUploader:
+    def __init__(self, backend, on_done = None,
+                 concurrency = upload_concurrency,
+                 chunk_size = upload_chunk_size,
+                 chunk_min = upload_chunk_min,
+                 chunk_max = upload_chunk_max,
+                 target_latency = upload_target_latency,
+                 retries = upload_retries,
+                 backoff = upload_backoff):
+        self.__backend = backend
+        self.__on_done = on_done
+        self.__concurrency = max(1, concurrency)
+        self.__chunk_min = max(1, chunk_min)
+        self.__chunk_max = max(self.__chunk_min, chunk_max)
+        self.__chunk_size = min(self.__chunk_max, max(self.__chunk_min, chunk_size))
+        self.__target_latency = target_latency
+        self.__retries = retries
+        self.__backoff = backoff
+
+        self.requests = 0
+        self.retried = 0
+        self.latencies = []
+
+    # Returns the final chunk size
+    def chunk_size(self):
+        return self.__chunk_size
+
+    def __adjust(self, latency, ok):
+        if not ok:
+            size = self.__chunk_size / 2
+        elif latency <= self.__target_latency:
+            size = self.__chunk_size + self.__chunk_min
+        else:
+            size = int(self.__chunk_size * self.__target_latency / latency)
+        self.__chunk_size = min(self.__chunk_max, max(self.__chunk_min, size))
+
+    def __send(self, chunk, attempt, results):
+        start = time.time()
+        try:
+            self.__backend.update(chunk)
+            err = None
+        except Exception, e:
+            err = e
+        results.put((chunk, attempt, err, time.time() - start))
+
+    # Sends all provided songs. Returns (number updated, [songs which failed all retries])
+    def run(self, songs):
+        total = len(songs)
+        pending = list(songs)
+        pending.reverse() # pop() from the end
+        retries = [] # heap of (time ready, attempt, chunk)
+        results = Queue.Queue()
+        inflight = 0
+        updated = 0
+        failed = []
+
+        while pending or retries or inflight:
+            # start as many chunks as allowed, retries first once they're due
+            now = time.time()
+            while inflight < self.__concurrency:
+                if retries and retries[0][0] <= now:
+                    ready, attempt, chunk = heapq.heappop(retries)
+                elif pending:
+                    attempt = 0
+                    chunk = pending[-self.__chunk_size:]
+                    chunk.reverse()
+                    del pending[-self.__chunk_size:]
+                else:
+                    break
+                t = threading.Thread(target=self.__send, args=(chunk, attempt, results))
+                t.daemon = True
+                t.start()
+                inflight += 1
+                self.requests += 1
+
+            if inflight == 0:
+                # only retries remain, none of them due yet
+                time.sleep(max(0, retries[0][0] - time.time()))
+                continue
+            chunk, attempt, err, latency = results.get()
+            inflight -= 1
+            self.latencies.append(latency)
+            metrics.observe("upload.chunk", latency)
+            self.__adjust(latency, err is None)
+
+            if err is None:
+                updated += len(chunk)
+                print "%d/%d songs updated (%d in %.2fs, chunk size now %d)" % \
+                    (updated, total, len(chunk), latency, self.__chunk_size)
+                if self.__on_done:
+                    self.__on_done(chunk)
+            elif attempt < self.__retries:
+                delay = self.__backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+                print "Update of %d songs failed (%s), retrying in %.1fs" % (len(chunk), err, delay)
+                # retry in pieces no larger than the (now smaller) chunk size
+                for i in xrange(0, len(chunk), self.__chunk_size):
+                    heapq.heappush(retries, (time.time() + delay, attempt + 1,
+                                             chunk[i:i + self.__chunk_size]))
+                self.retried += 1
+            else:
+                print "Giving up on %d songs: %s" % (len(chunk), err)
+                failed.extend(chunk)
+        return (updated, failed)
+
 ####
 # READING/UPDATING SONGS FROM GMUSIC
 ####
 
 from gmusicapi.api import Api
+import datetime
 import getpass
+import inspect
 
 class GMusicRater:
-    def __init__(self, files):
-        self.__api = Api()
-        self.__by_rating = {}
-        self.__needs_rating_update = []
+    # api defaults to a real gmusicapi Api, but may be anything with the same methods (eg FakeApi)
+    def __init__(self, files, db, fuzzy = fuzzy_match, ttl = cloud_cache_ttl, api = None):
+        api = api or Api()
+        try:
+            self.__delta = "updated_after" in inspect.getargspec(api.get_all_songs).args
+        except TypeError:
+            self.__delta = False
+        # every api call is timed into the metrics report
+        self.__api = TimedApi(api)
+        self.__db = db
 
         # fill list of songs
-        lib = []
-        cachefile = "gmusic.pickle"
-        if os.path.isfile(cachefile):
-            print "Loading cached library..."
-            infile = open(cachefile, "rb")
-            lib = cPickle.load(infile)
-        else:
-            self.__log_in()
-            print "Getting music..."
-            lib = self.__api.get_all_songs()
-            print "Writing..."
-            outfile = open(cachefile, "wb+")
-            cPickle.dump(lib, outfile)
-
-        # order list of songs by rating
-        notfound = []
-        total_found = 0
-        for s in lib:
-            r = files.find_rating(s)
-            # error finding file:
-            if r < 0:
-                notfound.append(s)
-                continue
+        fetched = db.get_meta("cloud_fetched")
+        with metrics.phase("cloud.refresh"):
+            if not db.has_cloud():
+                self.__refresh_library(None)
+            elif fetched is None or time.time() - fetched > ttl:
+                self.__refresh_library(fetched)
+            else:
+                print "Using cached library (%d minutes old)..." % ((time.time() - fetched) / 60)
+                metrics.count("cloud.cache_hits")
+
+        # match cloud songs against local files, to get their ratings
+        with metrics.phase("cloud.match"):
+            db.match_cloud()
+            total_found, notfound = db.cloud_matches()
+
+        if fuzzy and notfound:
+            print "Approximately matching %d songs..." % len(notfound)
+            phase = metrics.phase("cloud.fuzzy")
+            stillnotfound = []
+            matched = []
+            for s in notfound:
+                r = files.find_rating_fuzzy(s)
+                if r < 0:
+                    stillnotfound.append(s)
+                    continue
+                matched.append((s["id"], r))
+            db.set_local_ratings(matched)
+            phase.stop()
+            metrics.count("cloud.fuzzy_matched", len(matched))
+            print "Approximately matched %d songs." % len(matched)
+            total_found += len(matched)
+            notfound = stillnotfound
 
-            #print "Got rating for %s: %s" % (s["title"], s["rating"])
-            # file rating is different from cloud rating:
-            if not r == s["rating"]:
-                s["rating"] = r
-                self.__needs_rating_update.append(s)
-            if not self.__by_rating.has_key(r):
-                self.__by_rating[r] = []
-            self.__by_rating[r].append(s)
-            total_found += 1
+        # songs whose file rating is different from their cloud rating
+        with metrics.phase("cloud.diff"):
+            self.__needs_rating_update = db.cloud_changed()
+        metrics.count("cloud.matched", total_found)
+        metrics.count("cloud.not_found", len(notfound))
+        metrics.count("cloud.needs_update", len(self.__needs_rating_update))
 
         print "Found %d cloud songs, %d of which need rating updates." % \
             (total_found, len(self.__needs_rating_update))
@@ -228,6 +1320,28 @@ class GMusicRater:
         for s in notfound:
             print "  %s - %s" % (s["artist"], s["title"])
 
+    # Brings the cached cloud library up to date. If the api can list just the
+    # songs changed since a time (like gmusicapi's Mobileclient, with
+    # updated_after/include_deleted), only those are fetched. Otherwise the whole
+    # library is fetched, but still only changed songs are rewritten.
+    def __refresh_library(self, since):
+        self.__log_in()
+        start = time.time()
+        if since is not None and self.__delta:
+            print "Getting changes since %s..." % time.ctime(since)
+            songs = self.__api.get_all_songs(
+                updated_after=datetime.datetime.utcfromtimestamp(since), include_deleted=True)
+            removed = [s["id"] for s in songs if s.get("deleted")]
+            counts = self.__db.merge_cloud((s for s in songs if not s.get("deleted")), removed)
+        else:
+            print "Getting music..."
+            counts = self.__db.merge_cloud(self.__api.get_all_songs())
+        self.__db.set_meta("cloud_fetched", start)
+        metrics.count("cloud.added", counts[0])
+        metrics.count("cloud.changed", counts[1])
+        metrics.count("cloud.removed", counts[2])
+        print "Library refreshed: %d added, %d changed, %d removed." % counts
+
     def __log_in(self):
         if self.__api.is_authenticated():
             return
@@ -239,7 +1353,33 @@ class GMusicRater:
             print "couldnt log in"
             sys.exit(1)
 
+    # Returns [(playlist name, [song ids])] for the playlists we manage
+    def __playlist_songids(self):
+        awesome_songids = self.__db.cloud_ids(5)
+        good_songids = awesome_songids + self.__db.cloud_ids(4)
+        unrated_songids = self.__db.cloud_ids(0)
+        return [("Awesome", awesome_songids),
+                ("Good", good_songids),
+                ("Unrated", unrated_songids)]
+
+    def __add_songs(self, name, pid, songids):
+        for i in xrange(0, len(songids), playlist_batch_size):
+            batch = songids[i:i + playlist_batch_size]
+            self.__api.add_songs_to_playlist(pid, batch)
+            self.__db.add_playlist_songs(name, batch)
+
+    def __remove_songs(self, name, pid, songids):
+        for i in xrange(0, len(songids), playlist_batch_size):
+            batch = songids[i:i + playlist_batch_size]
+            self.__api.remove_songs_from_playlist(pid, batch)
+            self.__db.remove_playlist_songs(name, batch)
+
+    # Deletes all user playlists, then recreates the managed playlists from scratch
     def reset_playlists(self):
+        with metrics.phase("playlists"):
+            self.__reset_playlists()
+
+    def __reset_playlists(self):
         self.__log_in()
         playlists = self.__api.get_all_playlist_ids(auto=False, user=True)["user"]
         print "Got %d playlists:" % len(playlists)
@@ -248,63 +1388,416 @@ class GMusicRater:
             for playlistid in v:
                 self.__api.delete_playlist(playlistid)
 
-        def get_ids(slist):
-            ret = []
-            for s in slist:
-                ret.append(s["id"]);
-            return ret
-        awesome_songids = get_ids(self.__by_rating.get(5, []))
-        good_songids = awesome_songids + get_ids(self.__by_rating.get(4, []))
-        unrated_songids = get_ids(self.__by_rating.get(0, []))
+        for name, songids in self.__playlist_songids():
+            pid = self.__api.create_playlist(name)
+            self.__db.set_playlist(name, pid)
+            print "%s %s -> %d songs" % (name, pid, len(songids))
+            self.__add_songs(name, pid, songids)
+
+    # Brings the managed playlists up to date by only adding/removing the songs
+    # which changed since the last sync. Playlists we didn't create (or which
+    # were deleted since) are recreated from scratch, other playlists are left alone.
+    def sync_playlists(self):
+        with metrics.phase("playlists"):
+            self.__sync_playlists()
 
-        awesome_pid = self.__api.create_playlist("Awesome")
-        print "Awesome %s -> %d songs" % (awesome_pid, len(awesome_songids))
-        self.__api.add_songs_to_playlist(awesome_pid, awesome_songids)
+    def __sync_playlists(self):
+        self.__log_in()
+        playlists = self.__api.get_all_playlist_ids(auto=False, user=True)["user"]
+        for name, songids in self.__playlist_songids():
+            pid, current = self.__db.get_playlist(name)
+            existing = playlists.get(name, [])
+            if not pid in existing:
+                for playlistid in existing:
+                    print "  Deleting %s (%s)" % (name, playlistid)
+                    self.__api.delete_playlist(playlistid)
+                pid = self.__api.create_playlist(name)
+                self.__db.set_playlist(name, pid)
+                current = set()
+            else:
+                # duplicates of a managed playlist
+                for playlistid in existing:
+                    if playlistid != pid:
+                        print "  Deleting %s (%s)" % (name, playlistid)
+                        self.__api.delete_playlist(playlistid)
 
-        good_pid = self.__api.create_playlist("Good")
-        print "Good %s -> %d songs" % (good_pid, len(good_songids))
-        self.__api.add_songs_to_playlist(good_pid, good_songids)
+            wanted = set(songids)
+            # keep the original song order when adding
+            added = [i for i in songids if not i in current]
+            removed = sorted(current - wanted)
+            print "%s %s -> %d songs (+%d -%d)" % \
+                (name, pid, len(songids), len(added), len(removed))
+            metrics.count("playlists.added", len(added))
+            metrics.count("playlists.removed", len(removed))
+            self.__remove_songs(name, pid, removed)
+            self.__add_songs(name, pid, added)
 
-        unrated_pid = self.__api.create_playlist("Unrated")
-        print "Unrated %s -> %d songs" % (unrated_pid, len(unrated_songids))
-        self.__api.add_songs_to_playlist(unrated_pid, unrated_songids)
+    # Matches cloud songs against the files again, after the files changed.
+    # Matches all songs, or only those with the provided (nartist, ntitle)s.
+    def rematch(self, keys = None):
+        self.__db.match_cloud(keys)
+        self.__needs_rating_update = self.__db.cloud_changed()
 
-    def update_ratings(self):
+    def update_ratings(self, concurrency = upload_concurrency):
         total = len(self.__needs_rating_update)
         if total == 0:
             return
         self.__log_in()
         print "Updating %d songs..." % total
-        # divide updates into chunks.
-        start = 0
-        chunksz = 100 # could probably be larger, wasn't tested for max possible
-        while start < total:
-            end = start + chunksz
-            if end >= total:
-                end = total
-            print "%d - %d" % (start, end)
-            self.__api.change_song_metadata(self.__needs_rating_update[start:end])
-            start = end
+        # each chunk is written back to the database once it's applied, so an
+        # interrupted run picks up where it left off
+        uploader = BatchUploader(GMusicBackend(self.__api), self.__db.set_cloud_ratings,
+                                 concurrency)
+        with metrics.phase("update"):
+            updated, failed = uploader.run(self.__needs_rating_update)
+        metrics.count("update.songs", updated)
+        metrics.count("update.failed", len(failed))
+        metrics.count("update.requests", uploader.requests)
+        metrics.count("update.retried", uploader.retried)
+        print "Updated %d songs in %d requests (%d retried), %d failed." % \
+            (updated, uploader.requests, uploader.retried, len(failed))
+        self.__needs_rating_update = failed
 
     def logout(self):
         if self.__api.is_authenticated():
             print "Logging out..."
             self.__api.logout()
 
+####
+# WATCHING FOR CHANGES
+####
+
+# seconds without further changes to wait for before applying them, and the longest to ever wait:
+watch_delay = 2.0
+watch_max_delay = 10.0
+# seconds between rescans when some directories couldn't be watched (eg fs.inotify.max_user_watches was reached):
+watch_poll_interval = 300
+
+# Watches the library with inotify (using pyinotify), and pushes rating changes
+# as files are written, moved or deleted. Changes are collected until nothing
+# has changed for watch_delay seconds (or watch_max_delay has passed since the
+# first one), so that eg retagging an album results in one set of batched updates.
+class LibraryWatcher:
+    def __init__(self, path, db, rater, concurrency = upload_concurrency,
+                 workers = scan_workers, prune = prune_unchanged_dirs):
+        self.__path = os.path.normpath(path)
+        self.__db = db
+        self.__rater = rater
+        self.__concurrency = concurrency
+        # for rescanning, like the initial scan
+        self.__workers = workers
+        self.__prune = prune
+        self.__reset()
+
+    def __reset(self):
+        self.__changed = set()
+        self.__removed = set()
+        self.__added_dirs = set()
+        self.__removed_dirs = set()
+        self.__rescan = False
+        self.__first = None
+        self.__last = None
+
+    # Runs until interrupted
+    def run(self):
+        import pyinotify
+        self.__inotify = pyinotify
+        wm = pyinotify.WatchManager()
+        # IN_MOVE_SELF: lets pyinotify update the paths of watches on renamed directories,
+        # or else changes in them would show up under their old paths
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM | \
+            pyinotify.IN_DELETE | pyinotify.IN_CREATE | pyinotify.IN_MOVE_SELF
+        wdd = wm.add_watch(self.__path, mask, rec=True, auto_add=True)
+        notifier = pyinotify.Notifier(wm, self.__event)
+        unwatched = sorted(p for p, wd in wdd.iteritems() if wd < 0)
+        next_poll = None
+        if unwatched:
+            print "Couldn't watch %d of %d directories (eg %s), raising fs.inotify.max_user_watches may help." % \
+                (len(unwatched), len(wdd), unwatched[0])
+            print "Rescanning every %ds to pick up changes in them." % watch_poll_interval
+            next_poll = time.time() + watch_poll_interval
+        print "Watching %s for changes..." % self.__path
+        try:
+            while True:
+                deadlines = []
+                if self.__first:
+                    deadlines.append(min(self.__last + watch_delay, self.__first + watch_max_delay))
+                if next_poll:
+                    deadlines.append(next_poll)
+                timeout = None
+                if deadlines:
+                    timeout = max(0, int((min(deadlines) - time.time()) * 1000))
+                if notifier.check_events(timeout):
+                    notifier.read_events()
+                    notifier.process_events()
+                if next_poll and time.time() >= next_poll:
+                    print "Rescanning for changes in unwatched directories..."
+                    self.__rescan_all()
+                    next_poll = time.time() + watch_poll_interval
+                elif self.__first and time.time() >= min(self.__last + watch_delay,
+                                                         self.__first + watch_max_delay):
+                    self.__apply()
+        finally:
+            notifier.stop()
+
+    def __event(self, event):
+        mask = event.mask
+        pyinotify = self.__inotify
+        path = event.pathname
+        if mask & pyinotify.IN_Q_OVERFLOW:
+            # lost track of what changed
+            self.__rescan = True
+        elif mask & pyinotify.IN_MOVE_SELF:
+            # (the move is seen as IN_MOVED_FROM/TO by the directories involved)
+            return
+        elif event.dir:
+            if mask & (pyinotify.IN_MOVED_FROM | pyinotify.IN_DELETE):
+                self.__removed_dirs.add(path)
+                self.__added_dirs.discard(path)
+            elif mask & (pyinotify.IN_MOVED_TO | pyinotify.IN_CREATE):
+                self.__added_dirs.add(path)
+        elif os.path.splitext(path)[1] in music_exts:
+            if mask & (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO):
+                self.__changed.add(path)
+                self.__removed.discard(path)
+            elif mask & (pyinotify.IN_MOVED_FROM | pyinotify.IN_DELETE):
+                self.__removed.add(path)
+                self.__changed.discard(path)
+            else:
+                return
+        else:
+            return
+        self.__last = time.time()
+        if not self.__first:
+            self.__first = self.__last
+
+    # Returns the unicode version of a path, or None if it isn't valid UTF-8
+    @staticmethod
+    def __key(path):
+        try:
+            return path.decode("utf-8")
+        except UnicodeDecodeError:
+            print "Skipping non-UTF-8 filename: %r" % path
+            return None
+
+    # Picks up all changes, including any which are pending
+    def __rescan_all(self):
+        self.__reset()
+        SongFiles(self.__path, self.__db, self.__workers, self.__prune)
+        self.__rater.rematch()
+        self.__rater.update_ratings(self.__concurrency)
+
+    def __apply(self):
+        db = self.__db
+        if self.__rescan:
+            print "Missed some changes, rescanning..."
+            self.__rescan_all()
+            return
+
+        # (normalized artist, title) of every file added, changed or removed
+        keys = set()
+        for d in self.__removed_dirs:
+            d = LibraryWatcher.__key(d)
+            if d:
+                keys.update(db.delete_files_under(d))
+        # files moved into the library (and created before we were watching them)
+        for d in self.__added_dirs:
+            for root, dirs, files in os.walk(d):
+                for f in files:
+                    if os.path.splitext(f)[1] in music_exts:
+                        self.__changed.add(os.path.join(root, f))
+        changed = [p for p in self.__changed if os.path.isfile(p)]
+        removed = self.__removed.union(p for p in self.__changed if not os.path.isfile(p))
+        keys.update(db.delete_files(filter(None, map(LibraryWatcher.__key, removed))))
+
+        entries = []
+        for fpath, song, err in _read_batch(sorted(changed)):
+            key = LibraryWatcher.__key(fpath)
+            if not key:
+                continue
+            if err:
+                print "Couldn't read %s: %s" % (fpath, err)
+                continue
+            try:
+                st = os.stat(fpath)
+            except OSError, e:
+                print "Couldn't stat %s: %s" % (fpath, e)
+                continue
+            song.filename = key
+            entries.append((st.st_size, st.st_mtime, st.st_ino, song))
+            keys.add((normalize(song.artist), normalize(song.title)))
+        # the old tags of changed files, in case their artist/title changed
+        keys.update(db.delete_files(e[3].filename for e in entries))
+        db.put_files(entries)
+
+        print "%s: %d files changed, %d removed." % \
+            (time.strftime("%H:%M:%S"), len(entries), len(removed))
+        self.__reset()
+        self.__rater.rematch(keys)
+        self.__rater.update_ratings(self.__concurrency)
+
+import calendar
+
+# In-process stand-in for the parts of gmusicapi's Api used by GMusicRater,
+# for trying out syncs without touching a real account. Every call is counted
+# in self.calls.
+class FakeApi:
+    def __init__(self, lib = []):
+        self.songs = dict((s["id"], dict(s)) for s in lib)
+        # song id -> time last changed/deleted, for get_all_songs(updated_after)
+        self.modified = dict((i, 0) for i in self.songs)
+        self.deleted = {}
+        # playlist id -> [name, [song ids]]
+        self.playlists = {}
+        self.calls = {}
+        self.__next_pid = 0
+
+    def __called(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+    def is_authenticated(self):
+        return True
+
+    def login(self, email, password):
+        return True
+
+    def logout(self):
+        pass
+
+    def get_all_songs(self, incremental = False, updated_after = None, include_deleted = False):
+        self.__called("get_all_songs")
+        if updated_after is None:
+            return [dict(s) for s in self.songs.itervalues()]
+        since = calendar.timegm(updated_after.timetuple()) + updated_after.microsecond / 1e6
+        ret = [dict(s) for i, s in self.songs.iteritems() if self.modified[i] >= since]
+        if include_deleted:
+            ret.extend({"id": i, "deleted": True}
+                       for i, t in self.deleted.iteritems() if t >= since)
+        return ret
+
+    # Adds or changes a song, as if done from another client
+    def put_song(self, song):
+        self.songs[song["id"]] = dict(song)
+        self.modified[song["id"]] = time.time()
+        self.deleted.pop(song["id"], None)
+
+    # Deletes a song, as if done from another client
+    def delete_song(self, songid):
+        del self.songs[songid]
+        del self.modified[songid]
+        self.deleted[songid] = time.time()
+
+    def get_all_playlist_ids(self, auto = True, user = True):
+        self.__called("get_all_playlist_ids")
+        ret = {}
+        for pid, (name, songids) in self.playlists.iteritems():
+            ret.setdefault(name, []).append(pid)
+        return {"user": ret}
+
+    def create_playlist(self, name):
+        self.__called("create_playlist")
+        self.__next_pid += 1
+        pid = "fake-playlist-%d" % self.__next_pid
+        self.playlists[pid] = [name, []]
+        return pid
+
+    def delete_playlist(self, pid):
+        self.__called("delete_playlist")
+        del self.playlists[pid]
+        return pid
+
+    def add_songs_to_playlist(self, pid, songids):
+        self.__called("add_songs_to_playlist")
+        self.playlists[pid][1].extend(songids)
+
+    def remove_songs_from_playlist(self, pid, songids):
+        self.__called("remove_songs_from_playlist")
+        remove = set(songids)
+        self.playlists[pid][1] = [i for i in self.playlists[pid][1] if not i in remove]
+
+    def change_song_metadata(self, songs):
+        self.__called("change_song_metadata")
+        for s in songs:
+            self.put_song(s)
+
 ####
 # MAIN
 ####
 
+def usage_exit(argv):
+    print "Provide directory: %s [-f] [-p] [-r] [-w] [-j workers] [-c requests] [-t seconds] [-m report.json] [-v] <dir>" % argv[0]
+    print "  -f: retry songs which weren't found with approximate matching"
+    print "  -p: don't list directories which haven't changed since the last scan"
+    print "  -r: delete all user playlists and recreate them, instead of only applying changes"
+    print "  -w: after syncing, keep running and push rating changes as files change"
+    print "  -j: number of processes to parse tags with"
+    print "  -c: number of rating update requests to have in flight at once"
+    print "  -t: refresh the cached cloud library if it's older than this (0: always)"
+    print "  -m: when exiting, write a JSON report of timings and counts to this file"
+    print "  -v: print progress while scanning"
+    sys.exit(1)
+
 def main(argv):
-    if len(argv) < 2 or not os.path.isdir(argv[1]):
-        print "Provide directory: %s <dir>" % argv[0]
-        sys.exit(1)
-
-    files = SongFiles(argv[1])
-    cloud = GMusicRater(files)
-    cloud.reset_playlists()
-    cloud.update_ratings()
+    global progress_interval
+    try:
+        opts, args = getopt.getopt(argv[1:], "fprwvj:c:t:m:")
+    except getopt.GetoptError, e:
+        print e
+        usage_exit(argv)
+    workers = scan_workers
+    concurrency = upload_concurrency
+    ttl = cloud_cache_ttl
+    fuzzy = fuzzy_match
+    prune = prune_unchanged_dirs
+    reset = False
+    watch = False
+    report = metrics_report
+    for k, v in opts:
+        if k == "-f":
+            fuzzy = True
+        elif k == "-p":
+            prune = True
+        elif k == "-r":
+            reset = True
+        elif k == "-w":
+            watch = True
+        elif k == "-m":
+            report = v
+        elif k == "-v":
+            progress_interval = progress_interval or 5
+        elif k == "-j" or k == "-c" or k == "-t":
+            try:
+                n = int(v)
+            except ValueError:
+                usage_exit(argv)
+            if k == "-j":
+                workers = n
+            elif k == "-c":
+                concurrency = n
+            else:
+                ttl = n
+    if len(args) < 1 or not os.path.isdir(args[0]):
+        usage_exit(argv)
+    if report:
+        # also written when exiting early (eg a failed login or ^C), with whatever was measured by then
+        atexit.register(metrics.write_report, report)
+
+    db = LibraryDB()
+    db.import_legacy()
+    files = SongFiles(args[0], db, workers, prune)
+    cloud = GMusicRater(files, db, fuzzy, ttl)
+    if reset:
+        cloud.reset_playlists()
+    else:
+        cloud.sync_playlists()
+    cloud.update_ratings(concurrency)
+    if watch:
+        try:
+            LibraryWatcher(args[0], db, cloud, concurrency, workers, prune).run()
+        except KeyboardInterrupt:
+            pass
     cloud.logout()
+    db.close()
 
 if __name__ == "__main__":
     main(sys.argv)
@@ -27,12 +27,121 @@ token_path = os.path.expanduser("~/.greader_auth_token")
 netrc_path = ""
 # Change this if you want to use a different host from your .netrc:
 netrc_host = "www.google.com"
-# Set this to True to see any errors (it'll otherwise just produce a zero count):
+# Set this to True to see any errors in the output (they otherwise only go to
+# stderr, with this printed in place of the count):
 print_errors = False
+error_count = "?"
+# Seconds to reuse a count for before fetching it again (in the background,
+# while still printing the old one), or 0 to always fetch. Counts are cached
+# next to token_path, so this needs token_path.
+count_cache_ttl = 60
+# Added to a count when refreshing it has failed, with how old it is:
+stale_marker = " (%s old)"
+# Ids of feeds to also print unread counts for (add more with -f), eg "feed/http://example.com/rss":
+feed_ids = []
+
+# Specify a file listing several accounts to count (override with -a), or "" for
+# just the one above. One account per line: "<label> <netrc host> [<auth url> <unread count url>]"
+accounts_path = ""
+# URLs to get auth tokens and unread counts from, unless an account specifies its own:
+auth_url = "https://www.google.com/accounts/ClientLogin"
+unread_count_url = "http://www.google.com/reader/api/0/unread-count?output=json"
+# Connections to keep open to each host, and seconds to wait for a server to respond:
+max_host_connections = 4
+http_timeout = 30
 
 ### CODE ###
 
-import json, netrc, os, stat, sys, time, urllib, urllib2
+import fcntl, getopt, httplib, json, netrc, os, re, socket, stat, sys, threading, time, urllib, urlparse, zlib
+
+# Keeps idle HTTP(S) connections open per host, so that several requests to
+# the same host (eg auth and unread count, or several accounts) share them
+class ConnectionPool:
+    def __init__(self, max_per_host = max_host_connections, timeout = http_timeout):
+        self.__max_per_host = max_per_host
+        self.__timeout = timeout
+        self.__lock = threading.Lock()
+        # {(scheme, host:port): [idle connections]}
+        self.__idle = {}
+        # {(scheme, host:port): semaphore limiting the open connections}
+        self.__slots = {}
+        # total connections opened, for checking that they're reused
+        self.opened = 0
+
+    def __slot(self, key):
+        with self.__lock:
+            slot = self.__slots.get(key)
+            if not slot:
+                slot = threading.Semaphore(self.__max_per_host)
+                self.__slots[key] = slot
+            return slot
+
+    def __get(self, key):
+        with self.__lock:
+            idle = self.__idle.get(key)
+            if idle:
+                return (idle.pop(), True)
+            self.opened += 1
+        if key[0] == "https":
+            return (httplib.HTTPSConnection(key[1], timeout=self.__timeout), False)
+        return (httplib.HTTPConnection(key[1], timeout=self.__timeout), False)
+
+    def __put(self, key, conn):
+        with self.__lock:
+            self.__idle.setdefault(key, []).append(conn)
+
+    # Returns (status, body, {lowercase header: value}) for the request, raising
+    # Exception on connection errors. If 'reader' is provided, it's called with
+    # the response, and what it returns is used as the body. If it doesn't
+    # read the whole response, the connection is closed rather than reused.
+    def request(self, method, url, body = None, headers = {}, reader = None):
+        parts = urlparse.urlsplit(url)
+        if not parts.scheme in ("http", "https"):
+            raise Exception("Unsupported URL: %s" % url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        headers = dict(headers)
+        if body is not None:
+            headers.setdefault("Content-Type", "application/x-www-form-urlencoded")
+
+        slot = self.__slot(key)
+        slot.acquire()
+        try:
+            while True:
+                conn, reused = self.__get(key)
+                try:
+                    conn.request(method, path, body, headers)
+                    resp = conn.getresponse()
+                    if reader:
+                        data = reader(resp)
+                    else:
+                        data = resp.read()
+                except (httplib.HTTPException, socket.error), e:
+                    conn.close()
+                    if reused:
+                        # the server probably closed it while it was idle: try a new one
+                        continue
+                    if isinstance(e, socket.error) and e.strerror:
+                        raise Exception(e.strerror)
+                    raise Exception(str(e) or e.__class__.__name__)
+                if resp.will_close or not resp.isclosed():
+                    conn.close()
+                else:
+                    self.__put(key, conn)
+                return (resp.status, data, dict(resp.getheaders()))
+        finally:
+            slot.release()
+
+    def close(self):
+        with self.__lock:
+            for idle in self.__idle.itervalues():
+                for conn in idle:
+                    conn.close()
+            self.__idle.clear()
+
+pool = ConnectionPool()
 
 # Returns ("user", "password") or raises string in the event of an error
 def get_netrc_login(path, host):
@@ -52,17 +161,11 @@ def get_netrc_login(path, host):
     return login
 
 # Returns "authid" or raises a string in the event of an error
-def request_auth_token(email, password, service="reader"):
-    req_url = "https://www.google.com/accounts/ClientLogin"
+def request_auth_token(email, password, service="reader", req_url = None):
     req_data = urllib.urlencode({"Email": email, "Passwd": password, "service": service})
-    req = urllib2.Request(req_url, req_data)
-    try:
-        resp = urllib2.urlopen(req).read()
-    except urllib2.HTTPError, e:
-        raise Exception("HTTP Error %s" % e.code)
-    except urllib2.URLError, e:
-        raise Exception(e.reason)
-    print resp
+    status, resp, headers = pool.request("POST", req_url or auth_url, req_data)
+    if status >= 400:
+        raise Exception("HTTP Error %s" % status)
     try:
         resp_dict = dict(x.split("=") for x in resp.split("\n") if x)
         return resp_dict["Auth"]
@@ -77,46 +180,463 @@ def valid_auth_token(token_path):
     # (give it some margin)
     return (now - os.path.getmtime(token_path)) <= 10*86400
 
-def request_unread_count(auth_token):
-    req_url = "http://www.google.com/reader/api/0/unread-count?output=json"
-    req = urllib2.Request(req_url, None,
-                          {"Authorization": "GoogleLogin auth=%s" % auth_token})
+# Picks entries out of an unread-count document as it comes in, without
+# parsing (or even receiving) the rest of it once the wanted ones are found.
+# Only the objects in the "unreadcounts" array are decoded, one at a time,
+# and only those containing one of 'needles' (if specified).
+class UnreadCountScanner:
+    __token_re = re.compile(r'[{}\[\]"]')
+    __string_re = re.compile(r'"(?:[^"\\]|\\.)*"')
+    # the rest of an entry up to its end (or anything nested in it), in one go
+    __flat_re = re.compile(r'(?:[^"{}\[\]]|"(?:[^"\\]|\\.)*")*')
+    # a whole (flat) entry, and a run of them
+    __entry_re = re.compile(r'\{(?:[^"{}\[\]]|"(?:[^"\\]|\\.)*")*\}')
+    __entries_re = re.compile(r'(?:[\s,]*\{(?:[^"{}\[\]]|"(?:[^"\\]|\\.)*")*\})*')
+
+    def __init__(self, needles = None):
+        self.__needles = needles
+        self.__buf = ""
+        # position in __buf up to which it's been scanned
+        self.__pos = 0
+        self.__depth = 0
+        # last string seen at the top level of the document, ie its keys
+        self.__key = None
+        # whether we're in the unreadcounts array, and where the current entry started
+        self.__in_counts = False
+        self.__start = None
+        # whether the unreadcounts array was found at all
+        self.seen_counts = False
+
+    # Returns the entries ({"id": ..., "count": ...}) completed by this data
+    def feed(self, data):
+        buf = self.__buf + data
+        pos = self.__pos
+        entries = []
+        while True:
+            if self.__in_counts and self.__depth == 2:
+                # skip over complete entries without looking at each of them,
+                # unless they contain something wanted
+                end = self.__entries_re.match(buf, pos).end()
+                if end > pos:
+                    run = buf[pos:end]
+                    if not self.__needles or [n for n in self.__needles if n in run]:
+                        for e in self.__entry_re.finditer(run):
+                            self.__add(entries, e.group())
+                    pos = end
+            m = self.__token_re.search(buf, pos)
+            if not m:
+                pos = len(buf)
+                break
+            c = m.group()
+            if c == '"':
+                s = self.__string_re.match(buf, m.start())
+                if not s or s.end() == len(buf):
+                    # string continues in the next data (or the closing quote might)
+                    pos = m.start()
+                    break
+                if self.__depth == 1:
+                    self.__key = s.group()
+                pos = s.end()
+                continue
+            pos = m.end()
+            if c == "{" or c == "[":
+                self.__depth += 1
+                if c == "[" and self.__depth == 2 and self.__key == '"unreadcounts"':
+                    self.__in_counts = True
+                    self.seen_counts = True
+                elif c == "{" and self.__depth == 3 and self.__in_counts:
+                    self.__start = m.start()
+                    pos = self.__flat_re.match(buf, pos).end()
+            else:
+                self.__depth -= 1
+                if self.__depth == 2 and self.__start is not None:
+                    self.__add(entries, buf[self.__start:pos])
+                    self.__start = None
+                elif self.__depth == 1:
+                    self.__in_counts = False
+        # only keep what's still needed: the current entry, or a partial string
+        keep = self.__start
+        if keep is None:
+            keep = pos
+        self.__buf = buf[keep:]
+        self.__pos = pos - keep
+        if self.__start is not None:
+            self.__start = 0
+        return entries
+
+    def __add(self, entries, raw):
+        if not self.__needles or [n for n in self.__needles if n in raw]:
+            entries.append(json.loads(raw))
+
+# Reads the unread counts of the reading list and 'feeds' from a 200
+# response, stopping once all of them are found. Returns {id: count}.
+def read_unread_counts(resp, feeds):
+    if resp.status != 200:
+        resp.read()
+        return None
+    gzipped = resp.getheader("content-encoding", "").lower() == "gzip"
+    if gzipped:
+        # 16+: expect a gzip header
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    # the ids as they'd appear in the JSON, with or without escaped slashes
+    needles = ['reading-list"']
+    for f in feeds:
+        quoted = json.dumps(f)
+        if isinstance(f, unicode):
+            f = f.encode("utf-8")
+        needles += [quoted, quoted.replace("/", "\\/"), '"%s"' % f]
+    scanner = UnreadCountScanner(needles)
+    counts = {}
+    remaining = set(feeds)
+    found_total = False
+    while remaining or not found_total:
+        data = resp.read(16384)
+        if not data:
+            break
+        if gzipped:
+            data = decompressor.decompress(data)
+        for entry in scanner.feed(data):
+            feed_id = entry["id"]
+            if feed_id in remaining:
+                counts[feed_id] = entry["count"]
+                remaining.discard(feed_id)
+            if feed_id.endswith("reading-list"):
+                counts[feed_id] = entry["count"]
+                found_total = True
+    # eg a login page or an error document, which mustn't pass for zero unread
+    if not scanner.seen_counts:
+        raise ValueError("No unreadcounts in the response")
+    if not found_total:
+        raise ValueError("No reading-list count in the response")
+    return counts
+
+def _load_validators(path):
+    if not path:
+        return {}
     try:
-        resp = urllib2.urlopen(req).read()
-    except urllib2.HTTPError, e:
-        raise Exception("HTTP Error %s" % e.code)
-    except urllib2.URLError, e:
-        raise Exception(e.reason)
+        return json.load(open(path))
+    except (IOError, ValueError):
+        return {}
+
+def _save_validators(path, validators):
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    out = open(tmp_path, "w")
+    json.dump(validators, out)
+    out.close()
+    os.chmod(tmp_path, stat.S_IWUSR | stat.S_IRUSR)# = 600
+    os.rename(tmp_path, path)
+
+# Returns the total unread count, or (total, {feed id: count}) if 'feeds' are
+# specified. The response's ETag/Last-Modified and counts are kept in
+# 'validators_path' (if any), so that an unchanged document isn't sent again.
+def request_unread_count(auth_token, req_url = None, validators_path = None, feeds = ()):
+    req_url = req_url or unread_count_url
+    headers = {"Authorization": "GoogleLogin auth=%s" % auth_token,
+               "Accept-Encoding": "gzip"}
+    validators = _load_validators(validators_path)
+    saved = validators.get(req_url)
+    if saved and all(f in saved["counts"] for f in feeds):
+        if saved.get("etag"):
+            headers["If-None-Match"] = saved["etag"]
+        if saved.get("last_modified"):
+            headers["If-Modified-Since"] = saved["last_modified"]
+    else:
+        saved = None
 
     try:
-        doc = json.loads(resp)
-        counts = doc["unreadcounts"]
-        for c in counts:
-            if c["id"].endswith("reading-list"):
-                return c["count"]
-        return 0
-    except Exception, e:
-        raise Exception("Couldn't parse unread-count response. API change?: %s -> %s" % (resp, str(e)))
+        status, counts, resp_headers = pool.request(
+            "GET", req_url, None, headers,
+            lambda resp: read_unread_counts(resp, feeds))
+    except (ValueError, KeyError, TypeError, zlib.error), e:
+        raise Exception("Couldn't parse unread-count response. API change?: %s" % e)
+    if status == 304 and saved:
+        counts = saved["counts"]
+    elif status >= 400 or counts is None:
+        raise Exception("HTTP Error %s" % status)
+    elif validators_path and (resp_headers.get("etag") or resp_headers.get("last-modified")):
+        validators[req_url] = {"etag": resp_headers.get("etag"),
+                               "last_modified": resp_headers.get("last-modified"),
+                               "counts": counts}
+        _save_validators(validators_path, validators)
 
-def main():
+    total = 0
+    for feed_id, count in counts.iteritems():
+        if feed_id.endswith("reading-list"):
+            total = count
+    if feeds:
+        return (total, dict((f, counts.get(f, 0)) for f in feeds))
+    return total
+
+# Returns an auth token, from 'path' if it's still valid there, or else from
+# the web (then saved to 'path')
+def get_auth_token(user, pw, path, req_url = None):
+    if path and valid_auth_token(path):
+        # get token from file
+        return open(path, "r").read().strip()
+    # get token from web, write to file
+    auth_token = request_auth_token(user, pw, req_url=req_url)
+    if path:
+        open(path, "w").write("%s\n" % auth_token)
+        os.chmod(path, stat.S_IWUSR | stat.S_IRUSR)# = 600
+    return auth_token
+
+# Returns [(label, netrc host, auth url, unread count url)] from an accounts file
+def read_accounts(path):
     try:
-        (user, _, pw) = get_netrc_login(netrc_path, netrc_host)
-        if token_path and valid_auth_token(token_path):
-            # get token from file
-            auth_token = open(token_path, "r").read().strip()
+        lines = open(path).readlines()
+    except IOError, e:
+        raise Exception("Couldn't read %s: %s" % (path, os.strerror(e.errno)))
+    accounts = []
+    for i, line in enumerate(lines):
+        words = line.split("#")[0].split()
+        if not words:
+            continue
+        if len(words) == 2:
+            accounts.append((words[0], words[1], auth_url, unread_count_url))
+        elif len(words) == 4:
+            accounts.append(tuple(words))
         else:
-            # get token from web, write to file
-            auth_token = request_auth_token(user, pw)
-            if token_path:
-                open(token_path, "w").write("%s\n" % auth_token)
-                os.chmod(token_path, stat.S_IWUSR | stat.S_IRUSR)# = 600
-        print request_unread_count(auth_token)
+            raise Exception("%s:%d: Expected <label> <netrc host> [<auth url> <unread count url>]" % (path, i + 1))
+    return accounts
+
+# Returns the unread count (see request_unread_count()) for an account, raising Exception on errors
+def count_account(label, host, account_auth_url, account_unread_count_url, feeds = ()):
+    (user, _, pw) = get_netrc_login(netrc_path, host)
+    # each account gets its own token file
+    path = token_path and "%s-%s" % (token_path, label)
+    return request_unread_count(get_auth_token(user, pw, path, account_auth_url),
+                                account_unread_count_url, path and path + "-validators", feeds)
+
+# Returns the unread count (see request_unread_count()) for the netrc_host account, raising Exception on errors
+def count_default(feeds = ()):
+    (user, _, pw) = get_netrc_login(netrc_path, netrc_host)
+    return request_unread_count(get_auth_token(user, pw, token_path), None,
+                                token_path and token_path + "-validators", feeds)
+
+# Runs all the fetches at once. sources: [(key, function returning a count)]
+# Returns {key: (count or None, error or None)}.
+def fetch_counts(sources):
+    results = {}
+    def fetch(key, fn):
+        try:
+            results[key] = (fn(), None)
+        except Exception, e:
+            results[key] = (None, e)
+    if len(sources) == 1:
+        fetch(*sources[0])
+        return results
+    threads = [threading.Thread(target=fetch, args=source) for source in sources]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+# Unread counts shared between processes in a JSON file, as
+# {key: {"count": last good count, "time": when it was fetched,
+#        "error": last refresh error, "error_time": when that happened}}
+# Readers and writers take a flock() on path.lock, and the file is replaced
+# atomically so it's never seen half-written.
+class CountCache:
+    def __init__(self, path):
+        self.__path = path
+
+    def __lock(self, mode):
+        lock = open(self.__path + ".lock", "a")
+        fcntl.flock(lock, mode)
+        return lock
+
+    def __read(self):
+        try:
+            return json.load(open(self.__path))
+        except (IOError, ValueError):
+            return {}
+
+    def get(self, key):
+        lock = self.__lock(fcntl.LOCK_SH)
+        try:
+            return self.__read().get(key)
+        finally:
+            lock.close()
+
+    # Records a new count, or an error (keeping the last good count)
+    def put(self, key, count = None, error = None):
+        lock = self.__lock(fcntl.LOCK_EX)
+        try:
+            entries = self.__read()
+            entry = entries.setdefault(key, {})
+            if error is None:
+                entry["count"] = count
+                entry["time"] = time.time()
+                entry.pop("error", None)
+                entry.pop("error_time", None)
+            else:
+                entry["error"] = str(error)
+                entry["error_time"] = time.time()
+            tmp_path = "%s.%d.tmp" % (self.__path, os.getpid())
+            out = open(tmp_path, "w")
+            json.dump(entries, out)
+            out.close()
+            os.chmod(tmp_path, stat.S_IWUSR | stat.S_IRUSR)# = 600
+            os.rename(tmp_path, self.__path)
+        finally:
+            lock.close()
+
+    # Returns a lock to hold while refreshing, or None if another process is already refreshing
+    def refresh_lock(self):
+        lock = open(self.__path + ".refresh", "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock.close()
+            return None
+        return lock
+
+def get_count_cache():
+    if not token_path or count_cache_ttl <= 0:
+        return None
+    return CountCache("%s-counts" % token_path)
+
+# eg "45s", "12m", "3h"
+def format_age(seconds):
+    for unit, n in (("d", 86400), ("h", 3600), ("m", 60)):
+        if seconds >= n:
+            return "%d%s" % (seconds / n, unit)
+    return "%ds" % seconds
+
+# Returns ([(key, count or None, age marker, error or None)] in order, [sources to refresh]).
+# Cached counts are used if there are any, even if they're stale, in which case
+# they're also returned to be refreshed in the background (see refresh_counts()).
+# Counts which were never fetched are fetched now.
+def get_counts(sources, cache):
+    now = time.time()
+    cached = {}
+    missing = []
+    stale = []
+    for key, fn in sources:
+        entry = cache and cache.get(key)
+        if not entry or entry.get("count") is None:
+            missing.append((key, fn))
+            continue
+        age = now - entry["time"]
+        marker = ""
+        if age > count_cache_ttl:
+            stale.append((key, fn))
+            if entry.get("error"):
+                # the last refresh failed: say how old this is
+                marker = stale_marker % format_age(age)
+        cached[key] = (entry["count"], marker, None)
+
+    fetched = fetch_counts(missing)
+    for key, (count, err) in fetched.iteritems():
+        if cache:
+            cache.put(key, count, err)
+        cached[key] = (count, "", err)
+    return ([(key,) + cached[key] for key, fn in sources], stale)
+
+# Refreshes stale counts in a detached child process, so that we can exit right away
+def refresh_counts(sources, cache):
+    if not sources or not cache:
+        return
+    # or the child would print it again
+    sys.stdout.flush()
+    if os.fork() != 0:
+        return
+    try:
+        os.setsid()
+        # let whatever's reading our output see it end now
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        lock = cache.refresh_lock()
+        if lock:
+            for key, (count, err) in fetch_counts(sources).iteritems():
+                cache.put(key, count, err)
+            lock.close()
+    finally:
+        os._exit(0)
+
+def print_error(e, label = None):
+    # always to stderr, and to the output if print_errors
+    sys.stderr.write("%s%s\n" % (label and "%s: " % label or "", e))
+    if print_errors:
+        print "%s%s" % (label and "%s: " % label or "", e)
+    elif label:
+        print "%s: %s" % (label, error_count)
+    else:
+        print error_count
+
+# Returns the cache key for a count of 'label' (with 'feeds'), since counts with different feeds differ
+def count_key(label, feeds):
+    if feeds:
+        return "%s|%s" % (label, ",".join(feeds))
+    return label
+
+# Prints a count from get_counts(), with any feed counts indented below
+def print_count(count, marker, label = None, feeds = ()):
+    if feeds:
+        # (total, {feed: count}), or a list after a trip through the cache
+        count, feed_counts = count
+    if label:
+        print "%s: %d%s" % (label, count, marker)
+    else:
+        print "%d%s" % (count, marker)
+    for f in feeds:
+        print "  %s: %d" % (f, feed_counts.get(f, 0))
+    return count
+
+def main_accounts(path, feeds):
+    try:
+        accounts = read_accounts(path)
     except Exception, e:
-        if print_errors:
-            print e
+        print_error(e)
+        sys.exit(1)
+    cache = get_count_cache()
+    results, stale = get_counts([(count_key(a[0], feeds), lambda a=a: count_account(*a, feeds=feeds))
+                                 for a in accounts], cache)
+    total = 0
+    failed = False
+    for (label, count, marker, err), account in zip(results, accounts):
+        if err:
+            failed = True
+            print_error(err, account[0])
         else:
-            print "0"
+            total += print_count(count, marker, account[0], feeds)
+    if failed:
+        # only a lower bound: don't let it pass for the whole count
+        print "total: %d+%s" % (total, error_count)
+    else:
+        print "total: %d" % total
+    pool.close()
+    refresh_counts(stale, cache)
+    sys.exit(failed and 1 or 0)
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "a:f:")
+    except getopt.GetoptError, e:
+        print "%s\nArgs: %s [-a accounts file] [-f feed id]..." % (e, sys.argv[0])
+        sys.exit(1)
+    path = accounts_path
+    feeds = list(feed_ids)
+    for k, v in opts:
+        if k == "-a":
+            path = v
+        elif k == "-f":
+            feeds.append(v)
+    feeds = tuple(sorted(set(feeds)))
+    if path:
+        main_accounts(path, feeds)
+
+    cache = get_count_cache()
+    results, stale = get_counts([(count_key("", feeds), lambda: count_default(feeds))], cache)
+    key, count, marker, err = results[0]
+    if err:
+        print_error(err)
         sys.exit(1)
+    print_count(count, marker, None, feeds)
+    pool.close()
+    refresh_counts(stale, cache)
     sys.exit(0)
 
 if __name__ == "__main__":
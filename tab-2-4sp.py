@@ -0,0 +1,226 @@
+#!/usr/bin/python
+
+# Recursively replaces tabs with spaces in all the (text) files under a path.
+
+### OPTIONS ###
+
+# What each tab is replaced with:
+replacement = "    "
+# Files with a NUL byte in this many leading bytes are treated as binary and left alone:
+binary_check_size = 8192
+# Number of worker processes (override with -j), or 0 for one per CPU:
+default_workers = 0
+# Number of files handed to a worker at a time:
+batch_size = 64
+
+### CODE ###
+
+import getopt, mmap, multiprocessing, os, stat, sys, tempfile, time
+
+# Yields the paths of all regular files under 'path' (or 'path' itself), as they're
+# found. Symlinks, FIFOs, sockets and devices are skipped without being opened.
+def walk_files(path, errors):
+    if not os.path.isdir(path):
+        if stat.S_ISREG(os.lstat(path).st_mode):
+            yield path
+        return
+    def onerror(e):
+        errors.append(e)
+    for dirpath, dirnames, filenames in os.walk(path, onerror = onerror):
+        dirnames.sort()
+        for name in sorted(filenames):
+            fpath = os.path.join(dirpath, name)
+            try:
+                if stat.S_ISREG(os.lstat(fpath).st_mode):
+                    yield fpath
+            except OSError, e:
+                errors.append(e)
+
+# Results of checking/converting a file
+CONVERT = "convert"
+NO_TABS = "no tabs"
+BINARY = "binary"
+ERROR = "error"
+
+# Returns (path, result, size, error) for whether 'fpath' needs converting.
+# The file is mapped rather than read, so that files without tabs (most of them,
+# hopefully) are only scanned in place.
+def check_file(fpath):
+    try:
+        # O_NONBLOCK: in case it's been replaced with a FIFO since it was found
+        fd = os.open(fpath, os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            st = os.fstat(fd)
+            if not stat.S_ISREG(st.st_mode):
+                return (fpath, NO_TABS, 0, None)
+            if st.st_size == 0:
+                # (can't map an empty file)
+                return (fpath, NO_TABS, 0, None)
+            m = mmap.mmap(fd, 0, access = mmap.ACCESS_READ)
+            try:
+                if m.find("\0", 0, binary_check_size) != -1:
+                    return (fpath, BINARY, st.st_size, None)
+                if m.find("\t") == -1:
+                    return (fpath, NO_TABS, st.st_size, None)
+                return (fpath, CONVERT, st.st_size, None)
+            finally:
+                m.close()
+        finally:
+            os.close(fd)
+    except (IOError, OSError, mmap.error), e:
+        return (fpath, ERROR, 0, e)
+
+# Replaces the tabs in 'fpath', writing the result to a temporary file next to
+# it which is then renamed over it, so that the file is never left half-written.
+# Returns (path, result, size, error) like check_file(), with the new size.
+def convert_file(fpath):
+    tmp_path = None
+    try:
+        if not stat.S_ISREG(os.lstat(fpath).st_mode):
+            # replaced since it was checked
+            return (fpath, NO_TABS, 0, None)
+        f = open(fpath, "rb")
+        try:
+            st = os.fstat(f.fileno())
+            data = f.read()
+        finally:
+            f.close()
+        # it might have changed since it was checked
+        if "\0" in data[:binary_check_size]:
+            return (fpath, BINARY, len(data), None)
+        if not "\t" in data:
+            return (fpath, NO_TABS, len(data), None)
+        data = data.replace("\t", replacement)
+        dirname, name = os.path.split(fpath)
+        fd, tmp_path = tempfile.mkstemp(prefix = ".%s." % name, dir = dirname or ".")
+        out = os.fdopen(fd, "wb")
+        try:
+            out.write(data)
+        finally:
+            out.close()
+        os.chmod(tmp_path, stat.S_IMODE(st.st_mode))
+        os.rename(tmp_path, fpath)
+        return (fpath, CONVERT, len(data), None)
+    except (IOError, OSError), e:
+        if tmp_path:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+        return (fpath, ERROR, 0, e)
+
+# Runs 'func' on each of 'paths' (an iterable, consumed as it goes) in 'pool',
+# or in this process if there's no pool, yielding the results in any order
+def run_all(pool, func, paths):
+    if pool:
+        return pool.imap_unordered(func, paths, batch_size)
+    return (func(p) for p in paths)
+
+def format_rate(size, secs):
+    return "%.1f MB in %.2fs, %.1f MB/s" % (size / 1048576., secs, size / 1048576. / max(secs, 1e-6))
+
+def usage_exit(argv):
+    print "Syntax: %s [-j workers] <path>" % argv[0]
+    print "  Recursively searches <path> for files and replaces all tabs with spaces therein."
+    sys.exit(1)
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv[1:], "j:")
+    except getopt.GetoptError, e:
+        print e
+        usage_exit(argv)
+    if len(args) != 1:
+        # missing required arg
+        usage_exit(argv)
+    path = args[0]
+    workers = default_workers
+    for k, v in opts:
+        if k == "-j":
+            try:
+                workers = int(v)
+            except ValueError:
+                usage_exit(argv)
+    if not os.path.exists(path):
+        print "Error: Path '%s' doesn't exist" % path
+        usage_exit(argv)
+    if workers <= 0:
+        workers = multiprocessing.cpu_count()
+
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+    try:
+        print "Scanning '%s'..." % path
+        start = time.time()
+        walk_errors = []
+        tochange = []
+        scanned = scanned_size = binary = no_tabs = errors = 0
+        for fpath, result, size, err in run_all(pool, check_file, walk_files(path, walk_errors)):
+            scanned += 1
+            scanned_size += size
+            if result == CONVERT:
+                tochange.append(fpath)
+            elif result == BINARY:
+                binary += 1
+            elif result == NO_TABS:
+                no_tabs += 1
+            else:
+                print "Couldn't read %s: %s" % (fpath, err)
+                errors += 1
+        for e in walk_errors:
+            print "Couldn't list %s: %s" % (e.filename, e.strerror)
+            errors += 1
+        # (still reflected in the exit status after converting)
+        scan_errors = errors
+        print "Scanned %d files (%s): %d with tabs, %d binary skipped, %d without tabs, %d errors." % \
+            (scanned, format_rate(scanned_size, time.time() - start), len(tochange), binary,
+             no_tabs, errors)
+        if not tochange:
+            print "Nothing to do."
+            return errors and 1 or 0
+
+        tochange.sort()
+        print "The following files are about to be modified:"
+        for fpath in tochange:
+            print "  %s" % fpath
+
+        # prompt user with file list
+        while True:
+            try:
+                yn = raw_input("CONTINUE? [y/n] ")
+            except EOFError:
+                yn = "n"
+            if yn[:1] in ("Y", "y"):
+                break
+            elif yn[:1] in ("N", "n"):
+                print "Aborted."
+                return 0
+            print "Please answer yes or no."
+
+        # they approve -- get to work!
+        start = time.time()
+        changed = changed_size = skipped = errors = 0
+        for fpath, result, size, err in run_all(pool, convert_file, tochange):
+            if result == CONVERT:
+                changed += 1
+                changed_size += size
+            elif result == ERROR:
+                print "Got error on file %s: %s" % (fpath, err)
+                errors += 1
+            else:
+                # changed since it was scanned
+                skipped += 1
+        print "Changed %d files (%s), %d skipped, %d errors." % \
+            (changed, format_rate(changed_size, time.time() - start), skipped, errors)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+    print "Done."
+    if errors or scan_errors:
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
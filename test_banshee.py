@@ -0,0 +1,255 @@
+#!/usr/bin/python
+
+# Checks for the D-Bus wire protocol code in banshee.py, which listen_async
+# uses in place of dbus-python, and for listen_async itself against a fake
+# Banshee on a private bus (if dbus-daemon is installed). Run with
+# "python test_banshee.py".
+
+import distutils.spawn, os, shutil, subprocess, tempfile, time, unittest
+
+import banshee
+
+try:
+    import trollius
+    from trollius import From, Return
+except ImportError:
+    trollius = None
+
+class DbusMarshalTest(unittest.TestCase):
+    def roundtrip(self, sig, args):
+        fields = [(banshee._dbus_path, ("o", "/org/example/Path")),
+                  (banshee._dbus_member, ("s", "Method")),
+                  (banshee._dbus_reply_serial, ("u", 7))]
+        data = banshee._dbus_message(banshee._dbus_method_call, 42, fields, sig, args)
+        self.assertEqual(banshee._dbus_message_length(data[:16]), len(data))
+        msg = banshee._dbus_parse(data)
+        self.assertEqual(msg.type, banshee._dbus_method_call)
+        self.assertEqual(msg.serial, 42)
+        self.assertEqual(msg.fields[banshee._dbus_path], "/org/example/Path")
+        self.assertEqual(msg.fields[banshee._dbus_member], "Method")
+        self.assertEqual(msg.fields[banshee._dbus_reply_serial], 7)
+        self.assertEqual(msg.fields.get(banshee._dbus_signature, ""), sig)
+        return msg.body
+
+    def test_no_body(self):
+        self.assertEqual(self.roundtrip("", []), [])
+
+    def test_fixed(self):
+        args = [0xff, True, -2, 3, -4, 5, -(1 << 40), 1 << 60, 2.5]
+        self.assertEqual(self.roundtrip("ybnqiuxtd", args), args)
+
+    def test_strings(self):
+        args = [u"", u"caf\xe9", u"/a/b", "sa{sv}"]
+        self.assertEqual(self.roundtrip("sosg", args), args)
+
+    def test_containers(self):
+        track = {u"name": ("s", u"Song"), u"year": ("i", 1999), u"rating": ("y", 4),
+                 u"length": ("d", 123.5), u"tags": ("as", [u"a", u"b"])}
+        body = self.roundtrip("ya{sv}(is)as", [1, track, (3, u"x"), [u"p", u"q"]])
+        self.assertEqual(body[0], 1)
+        self.assertEqual(body[1], dict((k, v[1]) for k, v in track.items()))
+        self.assertEqual(body[2], (3, u"x"))
+        self.assertEqual(body[3], [u"p", u"q"])
+
+    def test_empty_containers(self):
+        self.assertEqual(self.roundtrip("a{sv}asai", [{}, [], []]), [{}, [], []])
+
+    def test_split(self):
+        self.assertEqual(banshee._dbus_split("sa{sv}i(a(ii)s)aai"),
+                         ["s", "a{sv}", "i", "(a(ii)s)", "aai"])
+
+@unittest.skipIf(trollius is None, "needs trollius")
+class AsyncDbusReaderTest(unittest.TestCase):
+    def setUp(self):
+        banshee.load_asyncio()
+        self.loop = trollius.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    # Returns an AsyncDbus reading 'data', with a call waiting for its reply
+    def run_reader(self, data):
+        class Writer:
+            def write(self, data):
+                pass
+            def close(self):
+                pass
+        conn = banshee.AsyncDbus(self.loop)
+        reader = trollius.StreamReader(loop=self.loop)
+        conn._AsyncDbus__reader = reader
+        conn._AsyncDbus__writer = Writer()
+        call = trollius.ensure_future(conn.call("org.example", "/", None, "Method", timeout=5), loop=self.loop)
+        self.loop.run_until_complete(trollius.sleep(0, loop=self.loop))
+        trollius.ensure_future(conn._AsyncDbus__read_messages(), loop=self.loop)
+        reader.feed_data(data)
+        reader.feed_eof()
+        self.loop.run_until_complete(trollius.wait([call, conn.closed], timeout=5, loop=self.loop))
+        self.assertTrue(call.done())
+        self.assertTrue(conn.closed.done())
+        return call, conn.closed
+
+    def test_reply(self):
+        reply = banshee._dbus_message(banshee._dbus_method_return, 1,
+                                      [(banshee._dbus_reply_serial, ("u", 1))], "s", [u"ok"])
+        call, closed = self.run_reader(reply)
+        self.assertEqual(call.result(), [u"ok"])
+        self.assertEqual(closed.result(), None)
+
+    def test_disconnect(self):
+        call, closed = self.run_reader("")
+        self.assertRaises(banshee.DbusError, call.result)
+        self.assertEqual(closed.result(), None)
+
+    def test_malformed(self):
+        # a reply whose body signature has an unknown type code
+        reply = banshee._dbus_message(banshee._dbus_method_return, 1,
+                                      [(banshee._dbus_reply_serial, ("u", 1)),
+                                       (banshee._dbus_signature, ("g", "z"))])
+        call, closed = self.run_reader(reply)
+        self.assertRaises(banshee.DbusError, call.result)
+        self.assertRaises(banshee.DbusError, closed.result)
+
+# Stands in for Banshee on a bus: answers GetCurrentState and GetCurrentTrack
+# with 'state' and 'track', and sends its signals with signal().
+class FakeBanshee:
+    def __init__(self, loop):
+        self.loop = loop
+        self.state = "idle"
+        self.track = {}
+        self.__serial = 0
+        self.__writer = None
+        # {serial: future for the reply}
+        self.__replies = {}
+
+    # Connects to the bus at 'address' (a unix:path= one) and takes Banshee's name
+    def start(self, address):
+        path = address.split("path=", 1)[1].split(",", 1)[0]
+        reader, self.__writer = yield From(trollius.open_unix_connection(path, loop=self.loop))
+        self.__writer.write("\0AUTH EXTERNAL %s\r\nBEGIN\r\n" % str(os.getuid()).encode("hex"))
+        line = yield From(reader.readline())
+        assert line.startswith("OK "), line
+        trollius.ensure_future(self.__read_messages(reader), loop=self.loop)
+        yield From(self.__call("Hello"))
+        yield From(self.__call("RequestName", "su", [banshee.banshee_status_interface, 0]))
+
+    def close(self):
+        self.__writer.close()
+
+    def signal(self, member, sig, args):
+        self.__send(banshee._dbus_signal,
+                    [(banshee._dbus_path, ("o", banshee.banshee_status_engine_path)),
+                     (banshee._dbus_interface, ("s", banshee.banshee_listen_interface)),
+                     (banshee._dbus_member, ("s", member))], sig, args)
+
+    def __send(self, msgtype, fields, sig = "", args = ()):
+        self.__serial += 1
+        self.__writer.write(banshee._dbus_message(msgtype, self.__serial, fields, sig, args))
+        return self.__serial
+
+    def __call(self, member, sig = "", args = ()):
+        serial = self.__send(banshee._dbus_method_call,
+                             [(banshee._dbus_path, ("o", banshee.dbus_bus_path)),
+                              (banshee._dbus_interface, ("s", banshee.dbus_bus_name)),
+                              (banshee._dbus_member, ("s", member)),
+                              (banshee._dbus_destination, ("s", banshee.dbus_bus_name))], sig, args)
+        reply = trollius.Future(loop=self.loop)
+        self.__replies[serial] = reply
+        result = yield From(reply)
+        raise Return(result)
+
+    def __read_messages(self, reader):
+        while True:
+            try:
+                head = yield From(reader.readexactly(16))
+                rest = yield From(reader.readexactly(banshee._dbus_message_length(head) - 16))
+            except (trollius.IncompleteReadError, IOError):
+                return
+            msg = banshee._dbus_parse(head + rest)
+            if msg.type == banshee._dbus_method_return:
+                reply = self.__replies.pop(msg.fields.get(banshee._dbus_reply_serial), None)
+                if reply:
+                    reply.set_result(msg.body)
+            elif msg.type == banshee._dbus_method_call:
+                member = msg.fields.get(banshee._dbus_member)
+                if member == "GetCurrentState":
+                    sig, args = "s", [self.state]
+                elif member == "GetCurrentTrack":
+                    sig, args = "a{sv}", [self.track]
+                else:
+                    continue
+                self.__send(banshee._dbus_method_return,
+                            [(banshee._dbus_reply_serial, ("u", msg.serial)),
+                             (banshee._dbus_destination, ("s", msg.fields.get(banshee._dbus_sender)))],
+                            sig, args)
+
+@unittest.skipIf(trollius is None, "needs trollius")
+@unittest.skipIf(not distutils.spawn.find_executable("dbus-daemon"), "needs dbus-daemon")
+class ListenAsyncTest(unittest.TestCase):
+    def setUp(self):
+        banshee.load_asyncio()
+        self.loop = trollius.new_event_loop()
+        self.tmp = tempfile.mkdtemp(prefix="test-banshee-")
+        self.out = os.path.join(self.tmp, "status")
+        self.stats = banshee.stats
+        banshee.stats = banshee.Stats()
+        self.bus = subprocess.Popen(["dbus-daemon", "--session", "--print-address", "--nofork"],
+                                    stdout=subprocess.PIPE, stderr=open(os.devnull, "w"))
+        self.address = self.bus.stdout.readline().strip()
+
+    def tearDown(self):
+        if self.bus.poll() is None:
+            self.bus.terminate()
+        self.bus.wait()
+        banshee.stats = self.stats
+        self.loop.close()
+        shutil.rmtree(self.tmp)
+
+    # Waits for 'status' to be written out
+    def wait_for(self, status):
+        end = time.time() + 5
+        while time.time() < end:
+            if os.path.exists(self.out) and open(self.out).read() == status + "\n":
+                return
+            yield From(trollius.sleep(0.01, loop=self.loop))
+        self.fail("Status %r never written, last %r" % (status, open(self.out).read()))
+
+    def track(self, i):
+        return {u"artist": ("s", u"Artist"), u"name": ("s", u"Song %d" % i), u"year": ("i", 2000 + i)}
+
+    def run_burst(self, count):
+        fake = FakeBanshee(self.loop)
+        fake.state = "playing"
+        fake.track = self.track(0)
+        yield From(fake.start(self.address))
+        listen = trollius.ensure_future(banshee.listen_async(["file:%s" % self.out], loop=self.loop,
+                                                             address=self.address), loop=self.loop)
+        # the initial status, once it's listening
+        yield From(self.wait_for("Artist - Song 0"))
+        for i in range(1, count + 1):
+            fake.track = self.track(i)
+            fake.signal(banshee.banshee_listen_signal, "ssd", ["startofstream", "", 0.0])
+            fake.signal(banshee.banshee_state_signal, "s", ["playing"])
+        yield From(self.wait_for("Artist - Song %d" % count))
+        # anything left over would be sent by now
+        yield From(trollius.sleep(banshee.coalesce_max_delay, loop=self.loop))
+        self.assertEqual(open(self.out).read(), "Artist - Song %d\n" % count)
+
+        # then Banshee closes
+        fake.close()
+        yield From(self.wait_for(banshee.closed_status))
+
+        # and it finishes once the bus goes away
+        self.bus.terminate()
+        yield From(trollius.wait_for(listen, 5, loop=self.loop))
+        self.assertEqual(listen.result(), None)
+
+    def test_burst(self):
+        self.loop.run_until_complete(self.run_burst(50))
+        counters = banshee.stats._Stats__counters
+        self.assertEqual(counters["events.received"], 101)
+        # the burst (or most of it) coalesced into a few queries
+        self.assertTrue(counters["events.coalesced"] > 0, counters)
+        self.assertTrue(counters["queries"] < 10, counters)
+
+if __name__ == "__main__":
+    unittest.main()
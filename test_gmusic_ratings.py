@@ -0,0 +1,80 @@
+#!/usr/bin/python
+
+# Checks for the library scan in gmusic-ratings.py, run against small trees of
+# files generated with gmusic-bench.py. Run with "python test_gmusic_ratings.py".
+
+import errno, imp, os, shutil, sys, tempfile, unittest
+
+_dir = os.path.dirname(os.path.abspath(__file__))
+try:
+    gmusic = imp.load_source("gmusic_ratings", os.path.join(_dir, "gmusic-ratings.py"))
+except ImportError, e:
+    gmusic = None
+    missing = str(e)
+bench = imp.load_source("gmusic_bench", os.path.join(_dir, "gmusic-bench.py"))
+
+@unittest.skipIf(gmusic is None, gmusic is None and "needs gmusic-ratings.py's prerequisites: %s" % missing)
+class SongFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="test-gmusic-")
+        self.root = os.path.join(self.tmp, "lib")
+        self.db = gmusic.LibraryDB(os.path.join(self.tmp, "library.db"))
+        # two files directly in the root, and some in subdirectories
+        self.write("a.mp3", u"Artist", u"A", 3)
+        self.write("b.mp3", u"Artist", u"B", 0)
+        self.write("Album/c.mp3", u"Other", u"C", 5)
+        self.write("Album/Disc 2/d.mp3", u"Other", u"D", 1)
+        self.write("Second/e.mp3", u"Third", u"E", 2)
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        self.db.close()
+        shutil.rmtree(self.tmp)
+
+    def write(self, relpath, artist, title, rating):
+        path = os.path.join(self.root, relpath)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, "wb").write(bench.make_mp3(artist, title, rating))
+
+    def scan(self, root, prune):
+        gmusic.SongFiles(root, self.db, 1, prune)
+        return self.db.count_files()[0]
+
+    def test_trailing_slash(self):
+        # eg from shell completion: the root directory is unchanged on the second run
+        for i in range(3):
+            self.assertEqual(self.scan(self.root + "/", True), 5)
+        self.assertEqual(self.scan(self.root, True), 5)
+        self.assertEqual(self.scan(self.root + "//", False), 5)
+
+    def test_unlistable_directory(self):
+        self.assertEqual(self.scan(self.root, False), 5)
+        album = os.path.join(self.root, "Album")
+        list_dir = gmusic._list_dir
+        def failing(path):
+            if path == album:
+                raise OSError(errno.EIO, "Input/output error")
+            return list_dir(path)
+        gmusic._list_dir = failing
+        try:
+            # kept, rather than dropped as deleted
+            self.assertEqual(self.scan(self.root, False), 5)
+        finally:
+            gmusic._list_dir = list_dir
+        # and listed again despite its unchanged mtime
+        os.remove(os.path.join(album, "Disc 2", "d.mp3"))
+        self.assertEqual(self.scan(self.root, True), 4)
+
+    def test_removed(self):
+        self.assertEqual(self.scan(self.root, True), 5)
+        shutil.rmtree(os.path.join(self.root, "Album"))
+        self.assertEqual(self.scan(self.root, True), 3)
+        os.remove(os.path.join(self.root, "a.mp3"))
+        self.assertEqual(self.scan(self.root + "/", True), 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,293 @@
+#!/usr/bin/python
+
+# Wakes WOL-enabled remote machines, then opens an SSH connection as soon as one accepts it.
+# Copyright (C) 2011  Nicholas Parker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+### OPTIONS ###
+
+# Machines which can be woken (or pass "<host>/<mac>" on the command line):
+# expected ip/host of the machine -> mac address of the machine
+mac_addresses = {
+    "SPECIFY_HOST_OR_IP_HERE": "SPECIFY_MAC_HERE",
+}
+# Host(s) to use when none are given on the command line:
+default_hosts = ["SPECIFY_HOST_OR_IP_HERE"]
+
+wol_send_ip = "SPECIFY_BROADCAST_IP_HERE" # broadcast address to send the WOL packet on
+wol_send_port = 7 # port to send WOL packet to (usually 7 or 9)
+# The magic packet is sent this many times in all, this far apart (it's UDP, so it might get lost):
+wol_sends = 3
+wol_send_interval = 1.0
+
+ssh_user = "SPECIFY_USER_HERE"
+ssh_flags = []
+ssh_port = 22 # override with -p
+ssh_exe = "ssh"
+
+# Seconds to wait for an answer before deciding that a machine is asleep and waking it:
+awake_timeout = 0.5
+# Seconds between connection attempts to the ssh port. Attempts start this often
+# again whenever the machine answers at all (ie it's up, but sshd isn't yet), and
+# otherwise slow down by probe_backoff each time, to at most probe_max_interval:
+probe_min_interval = 0.05
+probe_max_interval = 1.0
+probe_backoff = 1.5
+# Seconds to give each attempt before giving up on it (later ones continue meanwhile):
+probe_timeout = 2.0
+# Seconds to wait for the machine(s) before giving up, or 0 to wait forever (override with -t):
+wait_timeout = 300
+
+### CODE ###
+
+import errno, getopt, os, select, socket, sys, time
+
+def ECHO(msg):
+    print "%s %s" % (time.strftime("[%H:%M:%S]"), msg)
+    sys.stdout.flush()
+
+# Returns the magic packet for 'mac' ("01:23:45:67:89:ab", or with '-'s or nothing between)
+def wol_packet(mac):
+    digits = mac.replace(":", "").replace("-", "")
+    if len(digits) != 12:
+        raise ValueError("Invalid MAC address: %s" % mac)
+    return "\xff" * 6 + digits.decode("hex") * 16
+
+# Connect attempt results
+READY = "ready"
+REFUSED = "refused"
+FAILED = "failed"
+
+# One machine being woken and waited for. Several of these are polled together
+# by wait_ready(), which calls poll() whenever one of fds() is ready or when
+# deadline() is reached.
+class Machine:
+    def __init__(self, host, mac, port):
+        self.host = host
+        self.port = port
+        self.__mac = mac
+        family, socktype, proto, _, self.__addr = \
+            socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+        self.__family = family
+        # [(socket, give-up time)]
+        self.__probes = []
+        self.__interval = probe_min_interval
+        self.__start = time.time()
+        self.__next_probe = self.__start
+        # whether it's answered at all, and whether it's been found asleep
+        self.__awake = False
+        self.__woken = False
+        self.__wol_sends = 0
+        self.__next_wol = None
+        self.ready_after = None
+
+    def fds(self):
+        return [s for s, _ in self.__probes]
+
+    def deadline(self):
+        times = [self.__next_probe] + [t for _, t in self.__probes]
+        if self.__next_wol is not None:
+            times.append(self.__next_wol)
+        if not self.__awake and not self.__woken:
+            times.append(self.__start + awake_timeout)
+        return min(times)
+
+    # Handles any finished attempts among 'ready', and whatever's due by 'now'.
+    # Returns whether the ssh port is accepting connections.
+    def poll(self, ready, now):
+        probes = []
+        for s, give_up in self.__probes:
+            if s in ready:
+                result = self.__result(s)
+            elif give_up <= now:
+                result = FAILED
+            else:
+                probes.append((s, give_up))
+                continue
+            s.close()
+            self.__handle(result, now)
+        self.__probes = probes
+        if self.ready_after is not None:
+            self.close()
+            return True
+
+        if not self.__awake and not self.__woken and now >= self.__start + awake_timeout:
+            self.__woken = True
+            if self.__mac:
+                ECHO("%s appears to be asleep, sending WOL" % self.host)
+                self.__next_wol = now
+            else:
+                ECHO("%s appears to be asleep, but has no MAC to wake it with" % self.host)
+        if self.__next_wol is not None and now >= self.__next_wol:
+            self.__send_wol()
+            self.__wol_sends += 1
+            if self.__wol_sends < wol_sends:
+                self.__next_wol = now + wol_send_interval
+            else:
+                self.__next_wol = None
+        if now >= self.__next_probe:
+            self.__probe(now)
+        return False
+
+    def close(self):
+        for s, _ in self.__probes:
+            s.close()
+        self.__probes = []
+
+    def __handle(self, result, now):
+        if result == READY:
+            self.ready_after = now - self.__start
+        elif result == REFUSED:
+            # it's up, so sshd shouldn't be long now
+            if not self.__awake:
+                ECHO("%s is up, waiting for ssh..." % self.host)
+            self.__awake = True
+            self.__next_wol = None
+            self.__interval = probe_min_interval
+            self.__next_probe = min(self.__next_probe, now + self.__interval)
+
+    def __send_wol(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            s.sendto(wol_packet(self.__mac), (wol_send_ip, wol_send_port))
+        except socket.error, e:
+            ECHO("WOL for %s failed: %s" % (self.host, e))
+        finally:
+            s.close()
+
+    # Starts a non-blocking connect, to be picked up by poll() once it's writable
+    def __probe(self, now):
+        self.__next_probe = now + self.__interval
+        self.__interval = min(self.__interval * probe_backoff, probe_max_interval)
+        s = socket.socket(self.__family, socket.SOCK_STREAM)
+        s.setblocking(0)
+        err = s.connect_ex(self.__addr)
+        if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            # (even if it's connected already, it's picked up as writable)
+            self.__probes.append((s, now + probe_timeout))
+            return
+        s.close()
+        if err == errno.ECONNREFUSED:
+            self.__handle(REFUSED, now)
+        else:
+            self.__handle(FAILED, now)
+
+    def __result(self, s):
+        err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err == 0:
+            return READY
+        if err == errno.ECONNREFUSED:
+            return REFUSED
+        return FAILED
+
+# Waits until 'count' of 'machines' accept connections, or 'timeout' seconds
+# pass (if nonzero). Returns the ones which did, in the order they did.
+def wait_ready(machines, count, timeout):
+    waiting = list(machines)
+    ready = []
+    end = timeout and time.time() + timeout
+    while waiting and len(ready) < count:
+        now = time.time()
+        if end and now >= end:
+            break
+        wait = min(m.deadline() for m in waiting) - now
+        if end:
+            wait = min(wait, end - now)
+        fds = [s for m in waiting for s in m.fds()]
+        if fds:
+            _, writable, _ = select.select([], fds, [], max(wait, 0))
+        else:
+            writable = []
+            if wait > 0:
+                time.sleep(wait)
+        writable = set(writable)
+        now = time.time()
+        for m in list(waiting):
+            if m.poll(writable, now):
+                ECHO("%s is accepting ssh after %.2fs" % (m.host, m.ready_after))
+                waiting.remove(m)
+                ready.append(m)
+    for m in waiting:
+        m.close()
+    return ready
+
+def do_ssh(machine):
+    args = [ssh_exe] + ssh_flags
+    if machine.port != 22:
+        args += ["-p", str(machine.port)]
+    if ssh_user:
+        args.append("%s@%s" % (ssh_user, machine.host))
+    else:
+        args.append(machine.host)
+    sys.stdout.flush()
+    os.execvp(ssh_exe, args)
+
+def usage_exit(argv):
+    print """Syntax: %s [-n] [-p port] [-t timeout] [host[/mac]]...
+  Wakes each host (%s if none are given) and opens an SSH connection to the
+  first one to accept it.
+  -n  don't ssh, just wait until all of the hosts accept connections""" % (argv[0], " ".join(default_hosts))
+    sys.exit(1)
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv[1:], "np:t:")
+    except getopt.GetoptError, e:
+        print e
+        usage_exit(argv)
+    wait_only = False
+    port = ssh_port
+    timeout = wait_timeout
+    try:
+        for k, v in opts:
+            if k == "-n":
+                wait_only = True
+            elif k == "-p":
+                port = int(v)
+            elif k == "-t":
+                timeout = float(v)
+    except ValueError:
+        usage_exit(argv)
+
+    machines = []
+    for arg in args or default_hosts:
+        host, _, mac = arg.partition("/")
+        mac = mac or mac_addresses.get(host)
+        try:
+            if mac:
+                wol_packet(mac)
+            machines.append(Machine(host, mac, port))
+        except (ValueError, socket.error), e:
+            ECHO("Bad host %s: %s" % (arg, e))
+            return 1
+
+    for m in machines:
+        ECHO("Checking %s..." % m.host)
+    if wait_only:
+        count = len(machines)
+    else:
+        count = 1
+    ready = wait_ready(machines, count, timeout)
+    if len(ready) < count:
+        ECHO("Gave up waiting after %ss" % timeout)
+        return 1
+    if not wait_only:
+        ECHO("Machine is awake, running ssh")
+        do_ssh(ready[0])
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))